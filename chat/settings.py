@@ -187,6 +187,67 @@ CELERY_TIMEZONE = 'UTC'
 
 # Number of seconds of inactivity before a user is marked offline
 USER_ONLINE_TIMEOUT = 2 * 60  # 2 minutes
+# Number of seconds a user stays online after closing the last websocket,
+# so a page load doesn't send left/joined.
+USER_OFFLINE_GRACE = 5
+# Skip the last seen write while the previous one is younger than this
+# fraction of USER_ONLINE_TIMEOUT (0 - write on every request).
+USER_ONLINE_COALESCE = 0.25
+# Number of users per process to remember the last seen write for.
+USER_ONLINE_COALESCE_SIZE = 10000
+# Send user online status changes only to the user friends.
+PRESENCE_FRIENDS_ONLY = False
+
+# Create unread threads in a Celery task for threads with more members.
+UNREAD_THREADS_ASYNC_THRESHOLD = 50
+# Users per page of the user list and max users found by the search.
+USER_LIST_PAGE_SIZE = 50
+USER_SEARCH_LIMIT = 20
+
+# Users map tiles: cells per tile side are 2 ** USERS_MAP_GRID_BITS,
+# tiles list users instead of clusters from USERS_MAP_POINTS_ZOOM,
+# at most USERS_MAP_MAX_TILES tiles per request (lower zoom tiles for
+# bigger maps), cached for seconds.
+USERS_MAP_GRID_BITS = 3
+USERS_MAP_POINTS_ZOOM = 10
+USERS_MAP_MAX_TILES = 64
+USERS_MAP_TILE_TIMEOUT = 60 * 10
+
+# Seconds to cache the unread threads menu of a user, it is dropped
+# on changes, the timeout limits staleness of the last threads order.
+UNREAD_THREADS_CACHE_TIMEOUT = 60 * 5
+# Seconds to remember when a user read a thread, longer than
+# mark_thread_unread tasks can wait in the queue.
+UNREAD_THREADS_READ_TIMEOUT = 60 * 60
+
+# Language detection.
+LANG_DETECT_DEFAULT = 'en'
+# Texts shorter than this get LANG_DETECT_DEFAULT.
+LANG_DETECT_MIN_LENGTH = 4
+LANG_DETECT_CACHE_SIZE = 10000
+# Send messages first and detect their language in a Celery task.
+LANG_DETECT_DEFERRED = False
+
+# Write-behind message ingestion.
+# Broadcast new messages with a provisional id right away and insert them
+# in batches every MESSAGE_WRITE_BEHIND_INTERVAL seconds or when
+# MESSAGE_WRITE_BEHIND_BATCH messages are waiting.
+MESSAGE_WRITE_BEHIND = False
+MESSAGE_WRITE_BEHIND_INTERVAL = 0.05
+MESSAGE_WRITE_BEHIND_BATCH = 100
+# Seconds after which journals of a dead process are replayed.
+MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT = 30
+
+# Max number of missed messages sent to a reconnected thread socket,
+# the client reloads the page if it missed more.
+THREAD_RESUME_LIMIT = 500
+# Messages per page of the thread history API.
+MESSAGE_HISTORY_PAGE_SIZE = 50
+MESSAGE_HISTORY_MAX_PAGE_SIZE = 200
+# Number of last thread messages cached in Redis and shown on the thread
+# page, and seconds to keep them after the last change.
+THREAD_RECENT_MESSAGES = 50
+THREAD_RECENT_MESSAGES_TIMEOUT = 60 * 60 * 24
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
@@ -307,6 +368,8 @@ PYLINT_LOAD_PLUGIN = ['pylint_django']
 GOOGLE_MAP_API_KEY = get_env_var('GOOGLE_MAP_API_KEY')
 
 GEOIP_PATH = 'geo/'
+# IP locations cached by every process.
+GEOIP_CACHE_SIZE = 10000
 
 ASGI_APPLICATION = "core.routing.chat"
 CHATTERBOT = {
@@ -334,3 +397,8 @@ CHATTERBOT = {
         "chatterbot.corpus.russian"
     ]
 }
+# Chatbot responses cached by every Celery worker, answers of the
+# deterministic adapters never expire.
+CHATBOT_RESPONSE_CACHE_SIZE = 10000
+CHATBOT_RESPONSE_CACHE_TIMEOUT = 60 * 60
+CHATBOT_DETERMINISTIC_ADAPTERS = ['UnitConversion', 'MathematicalEvaluation']
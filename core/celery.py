@@ -15,12 +15,4 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
-
-app.conf.beat_schedule = {
-    'add-every-15-seconds': {
-        'task': 'core.tasks.update_user_statuses',
-        'schedule': 15.0,
-        'args': ()
-    },
-}
 app.conf.timezone = 'UTC'
@@ -0,0 +1,153 @@
+"""
+Chatbot.
+
+ChatterBot with its storage adapter and NLP dependencies is built once
+per process on the first response, so web and ASGI processes which only
+queue chatbot_response tasks never load it.
+
+Responses are cached by language and normalised text. Answers of
+CHATBOT_DETERMINISTIC_ADAPTERS (math, unit conversion) never change and
+are kept until evicted, other answers expire after
+CHATBOT_RESPONSE_CACHE_TIMEOUT seconds. Inputs answered from the cache
+or by those adapters directly are preprocessed and learned as
+ChatBot.get_response() does.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import language
+
+logger = logging.getLogger(__name__)
+
+_chatbot = None
+_chatbot_lock = threading.Lock()
+
+
+def get_chatbot():
+    """ Return the process-wide chatbot. """
+    global _chatbot
+    if _chatbot is None:
+        with _chatbot_lock:
+            if _chatbot is None:
+                from chatterbot import ChatBot
+
+                _chatbot = ChatBot(**settings.CHATTERBOT)
+
+    return _chatbot
+
+
+class ResponseCache:
+    """ Least recently used responses, optionally expiring. """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        # Key -> (response, expiry time or None).
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        """ Return the cached response or None. """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and \
+                    entry[1] <= now:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, response, permanent=False, now=None):
+        """ Cache the response, permanent ones never expire. """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.entries[key] = (
+                response, None if permanent else now + self.timeout
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """ Return hits, misses and the number of cached responses. """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
+
+
+responses = ResponseCache(settings.CHATBOT_RESPONSE_CACHE_SIZE,
+                          settings.CHATBOT_RESPONSE_CACHE_TIMEOUT)
+
+
+def _statement(chatbot, text):
+    """ Return the input statement after the chatbot preprocessors. """
+    from chatterbot.conversation import Statement
+
+    statement = Statement(text=text)
+    for preprocessor in chatbot.preprocessors:
+        statement = preprocessor(statement)
+    return statement
+
+
+def _learn(chatbot, statement, response):
+    """
+    Store the input and the response, as ChatBot.get_response() does
+    unless the chatbot is read only.
+    """
+    from chatterbot.conversation import Statement
+
+    if chatbot.read_only:
+        return
+
+    chatbot.learn_response(statement)
+    chatbot.storage.create(**Statement(
+        text=response, in_response_to=statement.text,
+        conversation=statement.conversation,
+        persona='bot:' + chatbot.name
+    ).serialize())
+
+
+def _generate(chatbot, text):
+    """ Return (response, True if it is deterministic). """
+    statement = _statement(chatbot, text)
+    for adapter in chatbot.logic_adapters:
+        if type(adapter).__name__ in \
+                settings.CHATBOT_DETERMINISTIC_ADAPTERS and \
+                adapter.can_process(statement):
+            result = adapter.process(statement)
+            # Confidence 1 means the adapter solved it.
+            if result.confidence == 1:
+                _learn(chatbot, statement, str(result))
+                return str(result), True
+
+    # Preprocesses and learns the input itself.
+    return str(chatbot.get_response(text)), False
+
+
+def get_response(text):
+    """ Return the chatbot response to the text. """
+    key = (language.detect(text), language.normalize(text))
+    response = responses.get(key)
+    if response is None:
+        response, permanent = _generate(get_chatbot(), text)
+        responses.set(key, response, permanent)
+        logger.debug('Chatbot response cache: %s', responses.stats())
+    else:
+        # Cached responses are learned as generated ones.
+        chatbot = get_chatbot()
+        _learn(chatbot, _statement(chatbot, text), response)
+
+    return response
@@ -1,91 +1,292 @@
-import langid
-
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from . import ingest, language, presence, unread
+from .models import Friend, Profile, UnreadThread, Message
+from .payloads import message_event, reload_event
+from .tasks import (chatbot_response, detect_messages_lang,
+                    mark_thread_unread, sweep_presence)
+
+User = get_user_model()
+
+
+class PresenceMixin:
+    """ Keep the user online while the webSocket is open. """
+    is_counted = False
+
+    def presence_connect(self):
+        """ Count the webSocket, send 'joined' if the user came online. """
+        user = self.scope.get('user')
+        if user.is_authenticated:
+            self.is_counted = True
+            if presence.connect(user.username):
+                Profile.send_status_changes(joined=[user.username])
 
-from .models import Profile, UnreadThread, Message
-from .tasks import chatbot_response
+    def presence_disconnect(self):
+        """
+        Forget the webSocket, send 'left' after a grace period if it was
+        the last one.
+        """
+        if self.is_counted:
+            self.is_counted = False
+            if presence.disconnect(self.scope.get('user').username):
+                sweep_presence.apply_async(
+                    countdown=settings.USER_OFFLINE_GRACE
+                )
 
-langid.set_languages([code for code, _ in settings.LANGUAGES])
+    def presence_ping(self):
+        """ Mark the user as seen and drop users who stopped pinging. """
+        joined = []
+        if self.is_counted:
+            username = self.scope.get('user').username
+            if presence.touch(username):
+                joined.append(username)
 
+        Profile.send_status_changes(joined, presence.sweep())
 
-class WsUsers(JsonWebsocketConsumer):
+
+class WsUsers(PresenceMixin, AsyncJsonWebsocketConsumer):
     """ WebsocketConsumer related to 'users' group. """
-    def connect(self):
+    group_name = None
+
+    async def connect(self):
         """ Adds to 'users' group and send a list of active users. """
-        async_to_sync(self.channel_layer.group_add)(
-            'users',
+        user = self.scope.get('user')
+        if settings.PRESENCE_FRIENDS_ONLY:
+            if not user.is_authenticated:
+                await self.close()
+                return
+            # Listen only to changes of the user friends.
+            self.group_name = presence.group_name(user.pk)
+        else:
+            self.group_name = presence.group_name()
+
+        await self.channel_layer.group_add(
+            self.group_name,
             self.channel_name
         )
-        super().connect()
-        self.send_json(Profile.get_online_users())
+        snapshot = await database_sync_to_async(self.join)()
+        await self.accept()
+        await self.send_json(snapshot)
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
         """ Remove from 'users' group and close the webSocket. """
-        async_to_sync(self.channel_layer.group_discard)(
-            'users',
-            self.channel_name
-        )
-        self.close()
+        await database_sync_to_async(self.presence_disconnect)()
+        if self.group_name:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+        await self.close()
 
-    def users_update(self, message):
+    async def receive_json(self, content, **kwargs):
+        if 'snapshot' in content:
+            # The client missed an update - send a full list again.
+            await self.send_json(
+                await database_sync_to_async(self.get_snapshot)()
+            )
+        elif 'ping' in content:
+            await database_sync_to_async(self.presence_ping)()
+
+    def join(self):
+        """ Mark the user online and return a full list of active users. """
+        self.presence_connect()
+        return self.get_snapshot()
+
+    def get_snapshot(self):
+        """ Return a full list of active users. """
+        if settings.PRESENCE_FRIENDS_ONLY:
+            user = self.scope.get('user')
+            return presence.snapshot(
+                user.pk, Friend.get_friends_usernames(user)
+            )
+
+        return presence.snapshot()
+
+    async def users_update(self, message):
         """ User binding. """
-        self.send_json(message['content'])
+        await self.send_json(message['content'])
 
 
-class WsThread(JsonWebsocketConsumer):
+class WsThread(PresenceMixin, AsyncJsonWebsocketConsumer):
     """ WebsocketConsumer related to specific 'thread' group. """
     thread_id = None
+    # Thread members: user id -> username.
+    members = None
 
-    def connect(self):
-        """ Adds to specific 'thread' group. """
+    async def connect(self):
+        """ Adds to specific 'thread' group if the user is a member. """
         self.thread_id = int(self.scope['url_route']['kwargs'].get('thread'))
 
-        async_to_sync(self.channel_layer.group_add)(
+        if not await database_sync_to_async(self.join)():
+            # Only thread members can connect.
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(
             'thread-{}'.format(str(self.thread_id)),
             self.channel_name
         )
-        super().connect()
+        await self.accept()
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
         """ Remove from specific 'thread' group and close the webSocket. """
-        async_to_sync(self.channel_layer.group_discard)(
+        await database_sync_to_async(self.presence_disconnect)()
+        await self.channel_layer.group_discard(
             'thread-{}'.format(str(self.thread_id)),
             self.channel_name
         )
-        self.close()
+        await self.close()
 
-    def receive_json(self, content, **kwargs):
+    async def receive_json(self, content, **kwargs):
+        # All database work of a frame is done in one thread hop.
         if 'text' in content:
-            message = Message(
-                thread_id=self.thread_id,
-                user=self.scope.get('user'),
-                text=content.get('text')
+            await database_sync_to_async(self.create_message)(
+                content.get('text')
             )
-            if message and message.thread.users.filter(pk=message.user.pk):
-                message.lang, _ = langid.classify(message.text)
-                message.save()
-
-                # Create unread thread for each user in thread,
-                # we will delete it latter.
-                for user in message.thread.users.all():
-                    if user.username == 'chatbot':
-                        # This is a message for chat bot.
-                        chatbot_response.delay(self.thread_id,
-                                               content.get('text'))
-                    else:
-                        UnreadThread.objects.get_or_create(
-                            thread_id=self.thread_id,
-                            user=user
-                        )
         elif 'read' in content:
-            # The message was delivered - delete user's unread thread.
-            UnreadThread.objects.filter(
-                thread_id=self.thread_id,
-                user=self.scope.get('user')
-            ).delete()
+            await database_sync_to_async(self.read_thread)()
+        elif 'ping' in content:
+            await database_sync_to_async(self.presence_ping)()
+        elif 'resume' in content:
+            # The client reconnected - send messages it missed.
+            for event in await database_sync_to_async(
+                self.get_missed_messages
+            )(content.get('resume')):
+                await self.send_json(event)
+
+    def load_members(self):
+        """ Load thread members, return True if the user is one of them. """
+        self.members = dict(
+            User.objects.filter(threads=self.thread_id)
+            .values_list('pk', 'username')
+        )
+        return self.scope.get('user').pk in self.members
+
+    def join(self):
+        """ Check membership and mark the user online. """
+        if not self.load_members():
+            return False
+
+        self.presence_connect()
+        return True
 
-    def message_update(self, message):
+    def create_message(self, text):
+        """ Save the message and mark the thread unread for its users. """
+        user = self.scope.get('user')
+        if user.pk not in self.members:
+            return
+
+        message = Message(
+            thread_id=self.thread_id,
+            user=user,
+            text=text
+        )
+        if not settings.LANG_DETECT_DEFERRED:
+            message.lang = language.detect(message.text)
+
+        if settings.MESSAGE_WRITE_BEHIND:
+            # Send the message now, save it with a batch later.
+            ingest.add(message)
+        elif settings.LANG_DETECT_DEFERRED:
+            # Send the message now, detect the language later.
+            message.save()
+            detect_messages_lang.delay([message.pk])
+        else:
+            message.save()
+
+        # Create unread thread for each user in thread,
+        # we will delete it latter.
+        user_ids = []
+        for user_id, username in self.members.items():
+            if username == 'chatbot':
+                # This is a message for chat bot.
+                chatbot_response.delay(self.thread_id, text)
+            else:
+                user_ids.append(user_id)
+
+        if len(user_ids) > settings.UNREAD_THREADS_ASYNC_THRESHOLD:
+            # Don't make the sender wait for big threads, members who
+            # read the message before the task runs are skipped.
+            mark_thread_unread.delay(self.thread_id, user_ids,
+                                     message.date.isoformat())
+        else:
+            UnreadThread.mark_unread(self.thread_id, user_ids)
+
+    def get_missed_messages(self, seq):
+        """
+        Return 'message.update' contents of messages after the sequence
+        number, ask the client to reload if too many were missed.
+        """
+        if not isinstance(seq, int):
+            return []
+
+        messages = list(
+            Message.objects.filter(thread_id=self.thread_id, seq__gt=seq)
+            .order_by('seq')[:settings.THREAD_RESUME_LIMIT + 1]
+        )
+        if len(messages) > settings.THREAD_RESUME_LIMIT:
+            return [reload_event()]
+
+        return [message_event('create', message) for message in messages]
+
+    def read_thread(self):
+        """ The message was delivered - delete user's unread thread. """
+        UnreadThread.mark_read(self.thread_id, self.scope.get('user').pk)
+
+    async def message_update(self, message):
         """ Message binding. """
-        self.send_json(message['content'])
+        await self.send_json(message['content'])
+
+    async def thread_members(self, message):
+        """ Thread members were changed - reload them. """
+        if not await database_sync_to_async(self.load_members)():
+            # The user was removed from the thread.
+            await self.close()
+
+
+class WsNotifications(AsyncJsonWebsocketConsumer):
+    """ WebsocketConsumer related to the user notifications group. """
+    group_name = None
+
+    async def connect(self):
+        """ Adds to the user group and send the unread threads menu. """
+        user = self.scope.get('user')
+        if not user.is_authenticated:
+            await self.close()
+            return
+
+        self.group_name = unread.notifications_group(user.pk)
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+        await self.accept()
+        # The menu could change since the page was rendered.
+        await self.notifications_update({'action': 'menu', 'thread': None})
+
+    async def disconnect(self, code):
+        """ Remove from the user group and close the webSocket. """
+        if self.group_name:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+        await self.close()
+
+    async def notifications_update(self, event):
+        """
+        A thread became unread or read - send the user menu, it is read
+        here so users without open pages don't cost anything.
+        """
+        menu = await database_sync_to_async(unread.get_menu)(
+            self.scope.get('user').pk
+        )
+        await self.send_json({
+            'action': event['action'],
+            'thread': event['thread'],
+            'unread_threads': menu['unread_threads'],
+            'threads': menu['threads'],
+        })
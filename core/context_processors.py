@@ -1,32 +1,20 @@
-from collections import namedtuple
+from django.utils.functional import SimpleLazyObject
 
-from .models import Thread, UnreadThread
+from . import unread
 
 
 def unread_threads(request):
-    """ Get unread messages. """
-    threads = []
-    unread_threads_counter = 0
-
-    if request.user.is_authenticated:
-        threads = UnreadThread.objects.filter(user=request.user)\
-            .order_by('-date')\
-            .values_list('thread__id', 'thread__name')[:10]
-
-        # Rename fields (thread__id to id, thread__name to name).
-        threads = [
-            namedtuple('Row', ('id', 'name'))(id=thread[0], name=thread[1])
-            for thread in threads
-        ]
-
-        unread_threads_counter = len(threads)
-
-        # If there no unread_threads_counter - show last threads.
-        if not threads:
-            threads = Thread.objects.filter(
-                users=request.user, last_message__isnull=False
-            ).order_by('-last_message').values_list(
-                'id', 'name', named=True
-            )[:10]
-
-    return {'threads': list(threads), 'unread_threads': unread_threads_counter}
+    """
+    Get unread messages, lazily: only templates which show them
+    read the cached menu (at most once per request).
+    """
+    if not request.user.is_authenticated:
+        return {'threads': [], 'unread_threads': 0}
+
+    user_id = request.user.pk
+    menu = SimpleLazyObject(lambda: unread.get_menu(user_id))
+
+    return {
+        'threads': SimpleLazyObject(lambda: menu['threads']),
+        'unread_threads': SimpleLazyObject(lambda: menu['unread_threads']),
+    }
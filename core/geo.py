@@ -0,0 +1,52 @@
+"""
+IP geolocation.
+
+The GeoIP2 database is opened once per process on first use, memory
+mapped and shared by all threads. Locations are cached by IP, private
+and invalid addresses are never looked up.
+"""
+import ipaddress
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+_geoip = None
+_geoip_lock = threading.Lock()
+
+
+def get_geoip():
+    """ Return the process-wide GeoIP2 reader. """
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                from django.contrib.gis.geoip2 import GeoIP2
+                from geoip2.database import MODE_MMAP
+
+                _geoip = GeoIP2(cache=MODE_MMAP)
+
+    return _geoip
+
+
+def is_public(ip):
+    """ Return True if the IP is a valid global address. """
+    try:
+        return ipaddress.ip_address(ip).is_global
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=settings.GEOIP_CACHE_SIZE)
+def lon_lat(ip):
+    """ Return (lon, lat) of the IP or None if it is unknown. """
+    from geoip2.errors import AddressNotFoundError
+
+    # GeoIP2 resolves anything else as a host name.
+    if not is_public(ip):
+        return None
+
+    try:
+        return get_geoip().lon_lat(ip)
+    except AddressNotFoundError:
+        return None
@@ -0,0 +1,326 @@
+"""
+Write-behind message ingestion.
+
+With MESSAGE_WRITE_BEHIND new messages are broadcast right away with
+a provisional id (the message nonce) and persisted by a per-process
+flusher thread with one bulk insert every MESSAGE_WRITE_BEHIND_INTERVAL
+seconds or MESSAGE_WRITE_BEHIND_BATCH messages. A 'reconcile' event then
+maps provisional ids to the persisted ones.
+
+A message is appended to a Redis journal of the process before it is
+broadcast and removed from it only after its batch is committed. The
+process keeps a lock key of its journal alive, journals whose lock has
+expired (the process died) are replayed by flushers of other processes.
+A stalled process registers its recovered journal again.
+Messages are inserted with a unique nonce, so a replay never duplicates
+a message which was committed right before the crash.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from . import recent
+from .models import Message, Thread
+from .payloads import message_event, reconcile_event
+
+logger = logging.getLogger(__name__)
+
+# Names of journals of all processes.
+JOURNALS_KEY = 'message_journals'
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _key(name):
+    # Respect the cache key prefix and version of the 'default' cache.
+    return cache.make_key(name)
+
+
+def _lock_key(journal):
+    return journal + ':lock'
+
+
+def _broadcast(thread_id, content):
+    async_to_sync(get_channel_layer().group_send)(
+        'thread-{}'.format(thread_id),
+        {'type': 'message.update', 'content': content}
+    )
+
+
+def persist(entries):
+    """
+    Insert journal entries, return a dict of thread id -> dict of
+    provisional id -> {'pk', 'seq'}. Entries already inserted are skipped.
+    """
+    nonces = [entry['nonce'] for entry in entries]
+    thread_ids = {entry['thread'] for entry in entries}
+    user_ids = {entry['user'] for entry in entries}
+    with transaction.atomic():
+        # Threads or users could be deleted in the meantime.
+        thread_ids &= set(Thread.objects.filter(
+            pk__in=thread_ids
+        ).values_list('pk', flat=True))
+        user_ids &= set(get_user_model().objects.filter(
+            pk__in=user_ids
+        ).values_list('pk', flat=True))
+        # A replayed batch could be committed before the crash.
+        inserted = {nonce.hex for nonce in Message.objects.filter(
+            nonce__in=nonces
+        ).values_list('nonce', flat=True)}
+
+        new_entries = defaultdict(list)
+        for entry in entries:
+            if entry['thread'] in thread_ids and \
+                    entry['user'] in user_ids and \
+                    entry['nonce'] not in inserted:
+                new_entries[entry['thread']].append(entry)
+
+        messages = []
+        now = timezone.now()
+        for thread_id, thread_entries in new_entries.items():
+            # Messages keep the date they were broadcast with (older
+            # journal entries have none).
+            dates = [parse_datetime(entry['date']) if 'date' in entry else now
+                     for entry in thread_entries]
+            # One sequence numbers range and last message date update
+            # per thread for the batch.
+            last_seq = Thread.reserve_seq(thread_id, max(dates),
+                                          len(thread_entries))
+            for seq, entry, date in zip(
+                range(last_seq - len(thread_entries) + 1, last_seq + 1),
+                thread_entries, dates
+            ):
+                messages.append(Message(
+                    nonce=entry['nonce'], thread_id=thread_id,
+                    user_id=entry['user'], text=entry['text'],
+                    lang=entry['lang'], seq=seq, date=date
+                ))
+        Message.objects.bulk_create(messages, ignore_conflicts=True)
+
+        ids = defaultdict(dict)
+        persisted = list(Message.objects.filter(
+            nonce__in=nonces
+        ).order_by('seq'))
+        for message in persisted:
+            ids[message.thread_id][message.nonce.hex] = {
+                'pk': message.pk, 'seq': message.seq
+            }
+
+        transaction.on_commit(lambda: recent.push([
+            message for message in persisted
+            if message.nonce.hex not in inserted
+        ]))
+
+    return ids
+
+
+def reconcile(ids):
+    """ Send provisional -> persisted ids to thread members. """
+    for thread_id, thread_ids in ids.items():
+        _broadcast(thread_id, reconcile_event(thread_ids))
+
+    if settings.LANG_DETECT_DEFERRED:
+        from .tasks import detect_messages_lang
+
+        pks = [message['pk'] for thread_ids in ids.values()
+               for message in thread_ids.values()]
+        if pks:
+            detect_messages_lang.delay(pks)
+
+
+def recover(owner=None):
+    """
+    Replay journals of dead processes (except the owner journal),
+    return the number of replayed messages.
+    """
+    conn = _redis()
+    recovered = 0
+    for journal in conn.smembers(_key(JOURNALS_KEY)):
+        journal = journal.decode()
+        if journal == owner or not conn.set(
+            _lock_key(journal), owner or '', nx=True,
+            ex=settings.MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT
+        ):
+            # Own journal or the owner is alive.
+            continue
+
+        while True:
+            batch = conn.lrange(
+                journal, 0, settings.MESSAGE_WRITE_BEHIND_BATCH - 1
+            )
+            if not batch:
+                break
+            ids = persist([json.loads(raw) for raw in batch])
+            pipe = conn.pipeline()
+            for raw in batch:
+                pipe.lrem(journal, 1, raw)
+            pipe.expire(_lock_key(journal),
+                        settings.MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT)
+            pipe.execute()
+            reconcile(ids)
+            recovered += len(batch)
+            logger.warning('Recovered %s messages from %s',
+                           len(batch), journal)
+
+        pipe = conn.pipeline()
+        pipe.srem(_key(JOURNALS_KEY), journal)
+        pipe.delete(_lock_key(journal))
+        pipe.execute()
+
+    return recovered
+
+
+class MessageBuffer:
+    """ Messages of this process waiting to be persisted. """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.journal = _key('message_journal:{}:{}:{}'.format(
+            socket.gethostname(), self.pid, uuid.uuid4().hex
+        ))
+        # Raw journal entries in the journal order.
+        self.entries = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.refresh_lock()
+        self.thread = threading.Thread(
+            target=self.run, name='message-flusher', daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def refresh_lock(self):
+        """
+        Keep the journal lock alive, register the journal again in case
+        it was recovered while this process was stalled.
+        """
+        pipe = _redis().pipeline()
+        pipe.set(_lock_key(self.journal), self.journal,
+                 ex=settings.MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT)
+        pipe.sadd(_key(JOURNALS_KEY), self.journal)
+        pipe.execute()
+
+    def add(self, message):
+        """ Journal the message and broadcast it with a provisional id. """
+        message.nonce = uuid.uuid4()
+        message.date = timezone.now()
+        raw = json.dumps({
+            'nonce': message.nonce.hex,
+            'thread': message.thread_id,
+            'user': message.user_id,
+            'text': message.text,
+            'lang': message.lang,
+            'date': message.date.isoformat(),
+        })
+        with self.lock:
+            # Journal first, so a broadcast message is never lost.
+            pipe = _redis().pipeline()
+            pipe.rpush(self.journal, raw)
+            pipe.sadd(_key(JOURNALS_KEY), self.journal)
+            pipe.execute()
+            self.entries.append(raw)
+            is_full = len(self.entries) >= \
+                settings.MESSAGE_WRITE_BEHIND_BATCH
+        if is_full:
+            self.wakeup.set()
+
+        _broadcast(message.thread_id,
+                   message_event('create', message, pk=message.nonce.hex))
+
+    def flush(self):
+        """ Persist a batch, return the number of persisted messages. """
+        with self.lock:
+            batch = self.entries[:settings.MESSAGE_WRITE_BEHIND_BATCH]
+        if not batch:
+            return 0
+
+        ids = persist([json.loads(raw) for raw in batch])
+        pipe = _redis().pipeline()
+        for raw in batch:
+            pipe.lrem(self.journal, 1, raw)
+        pipe.execute()
+        with self.lock:
+            del self.entries[:len(batch)]
+
+        reconcile(ids)
+        return len(batch)
+
+    def run(self):
+        """ Flusher thread loop. """
+        # The lock is refreshed in __init__.
+        refreshed_at = time.monotonic()
+        recovered_at = 0
+        while True:
+            self.wakeup.wait(settings.MESSAGE_WRITE_BEHIND_INTERVAL)
+            self.wakeup.clear()
+            try:
+                now = time.monotonic()
+                if now - refreshed_at > \
+                        settings.MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT / 3:
+                    refreshed_at = now
+                    self.refresh_lock()
+                while self.flush() >= settings.MESSAGE_WRITE_BEHIND_BATCH:
+                    pass
+                now = time.monotonic()
+                if now - recovered_at > \
+                        settings.MESSAGE_WRITE_BEHIND_LOCK_TIMEOUT / 2:
+                    recovered_at = now
+                    recover(self.journal)
+            except Exception:
+                # Entries stay in the buffer and the journal, try again.
+                logger.exception('Failed to persist buffered messages')
+            finally:
+                close_old_connections()
+
+            if self.stopping and not self.entries:
+                return
+
+    def close(self, timeout=10):
+        """ Persist the rest of the messages, drop the journal. """
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join(timeout)
+        if not self.entries:
+            pipe = _redis().pipeline()
+            pipe.srem(_key(JOURNALS_KEY), self.journal)
+            pipe.delete(self.journal, _lock_key(self.journal))
+            pipe.execute()
+
+
+def get_buffer():
+    """ Return the message buffer of this process. """
+    global _buffer
+    # A forked process starts own buffer and flusher thread.
+    if _buffer is None or _buffer.pid != os.getpid():
+        with _buffer_lock:
+            if _buffer is None or _buffer.pid != os.getpid():
+                _buffer = MessageBuffer()
+
+    return _buffer
+
+
+def add(message):
+    """ Broadcast the message now, persist it in the background. """
+    get_buffer().add(message)
@@ -0,0 +1,75 @@
+"""
+Language detection.
+
+The langid model is loaded once per process on first use and limited to
+settings.LANGUAGES. Results are cached by normalised text, very short
+texts get LANG_DETECT_DEFAULT as there is nothing to detect.
+"""
+import threading
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+_identifier = None
+_identifier_lock = threading.Lock()
+
+
+def get_identifier():
+    """ Return the process-wide langid identifier. """
+    global _identifier
+    if _identifier is None:
+        with _identifier_lock:
+            if _identifier is None:
+                from langid.langid import LanguageIdentifier, model
+
+                identifier = LanguageIdentifier.from_modelstring(model)
+                identifier.set_languages(
+                    [code for code, _ in settings.LANGUAGES]
+                )
+                _identifier = identifier
+
+    return _identifier
+
+
+def normalize(text):
+    """ Lowercase the text and collapse whitespaces. """
+    return ' '.join(text.lower().split())
+
+
+@lru_cache(maxsize=settings.LANG_DETECT_CACHE_SIZE)
+def _detect(text):
+    lang, _ = get_identifier().classify(text)
+    return lang
+
+
+def detect(text):
+    """ Return the language code of the text. """
+    text = normalize(text)
+    if len(text) < settings.LANG_DETECT_MIN_LENGTH:
+        return settings.LANG_DETECT_DEFAULT
+
+    return _detect(text)
+
+
+def detect_many(texts):
+    """ Return language codes of the texts, classify them in one batch. """
+    texts = [normalize(text) for text in texts]
+    to_classify = list({
+        text for text in texts
+        if len(text) >= settings.LANG_DETECT_MIN_LENGTH
+    })
+
+    langs = {}
+    if to_classify:
+        identifier = get_identifier()
+        features = np.array([
+            identifier.instance2fv(text) for text in to_classify
+        ])
+        probs = identifier.nb_classprobs(features)
+        langs = {
+            text: str(identifier.nb_classes[cl])
+            for text, cl in zip(to_classify, np.argmax(probs, axis=1))
+        }
+
+    return [langs.get(text, settings.LANG_DETECT_DEFAULT) for text in texts]
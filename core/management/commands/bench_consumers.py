@@ -0,0 +1,167 @@
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import JsonWebsocketConsumer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf.urls import url
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core.consumers import PresenceMixin, WsThread
+from core.models import Thread
+
+User = get_user_model()
+
+
+class SyncWsThread(PresenceMixin, JsonWebsocketConsumer):
+    """ WsThread as it was before async consumers, does the same work. """
+    thread_id = None
+
+    def connect(self):
+        self.thread_id = int(self.scope['url_route']['kwargs'].get('thread'))
+        if not self.load_members():
+            self.close()
+            return
+
+        async_to_sync(self.channel_layer.group_add)(
+            'thread-{}'.format(str(self.thread_id)),
+            self.channel_name
+        )
+        super().connect()
+        self.presence_connect()
+
+    def disconnect(self, code):
+        self.presence_disconnect()
+        async_to_sync(self.channel_layer.group_discard)(
+            'thread-{}'.format(str(self.thread_id)),
+            self.channel_name
+        )
+
+    def receive_json(self, content, **kwargs):
+        if 'text' in content:
+            self.create_message(content.get('text'))
+
+    load_members = WsThread.load_members
+    create_message = WsThread.create_message
+
+    def message_update(self, message):
+        self.send_json(message['content'])
+
+
+def message_text(content):
+    """ Get message text from 'message.update' content. """
+    fields = content['payload']['data'].get('fields')
+    return fields['text'] if fields else None
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for comparing sync and async
+    thread consumers: memory per open socket and per-message latency.
+    """
+
+    help = 'Compares sockets per process and per-message latency of ' \
+           'sync and async thread consumers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of messages sent at the same time')
+
+    async def run(self, consumer, thread, user, sockets, messages):
+        """ Open sockets, send messages and measure it. """
+        application = URLRouter([
+            url(r"^ws/thread/(?P<thread>\w+)$", consumer),
+        ])
+        communicators = []
+        for _ in range(sockets):
+            communicator = WebsocketCommunicator(
+                application, '/ws/thread/{}'.format(thread.pk)
+            )
+            communicator.scope['user'] = user
+            communicators.append(communicator)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(communicator.connect(timeout=30)
+              for communicator in communicators),
+            return_exceptions=True
+        )
+        connect_time = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        connected = [
+            communicator
+            for communicator, result in zip(communicators, results)
+            if not isinstance(result, BaseException) and result[0]
+        ]
+
+        latencies = []
+
+        async def send(communicator, i):
+            text = 'bench message {}'.format(i)
+            started = time.perf_counter()
+            await communicator.send_json_to({'text': text})
+            # Wait for the message to come back via the thread group.
+            while message_text(
+                    await communicator.receive_json_from(timeout=60)
+            ) != text:
+                pass
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            send(communicator, i)
+            for i, communicator in enumerate(connected[:messages])
+        ))
+        send_time = time.perf_counter() - started
+
+        await asyncio.gather(*(
+            communicator.disconnect() for communicator in connected
+        ))
+
+        return {
+            'connected': len(connected),
+            'connect_time': connect_time,
+            'memory_per_socket': memory / max(len(connected), 1),
+            'latencies': sorted(latencies),
+            'send_time': send_time,
+        }
+
+    def handle(self, *args, **options):
+        sockets = options['sockets']
+        messages = min(options['messages'], sockets)
+
+        user = User.objects.create_user(username='bench_consumers_user')
+        peer = User.objects.create_user(username='bench_consumers_peer')
+        thread = Thread.objects.create(name='bench_consumers')
+        thread.users.add(user, peer)
+        try:
+            for name, consumer in (('sync', SyncWsThread),
+                                   ('async', WsThread)):
+                result = asyncio.run(
+                    self.run(consumer, thread, user, sockets, messages)
+                )
+                latencies = result['latencies'] or [0]
+                self.stdout.write(
+                    '{}: {}/{} sockets connected in {:.2f}s, '
+                    '{:.1f} KiB per socket; {} messages in {:.2f}s, '
+                    'latency p50 {:.1f}ms, p99 {:.1f}ms'.format(
+                        name, result['connected'], sockets,
+                        result['connect_time'],
+                        result['memory_per_socket'] / 1024,
+                        len(result['latencies']), result['send_time'],
+                        statistics.median(latencies) * 1000,
+                        latencies[int(len(latencies) * 0.99)] * 1000,
+                    )
+                )
+        finally:
+            thread.delete()
+            user.delete()
+            peer.delete()
@@ -0,0 +1,59 @@
+import random
+from types import SimpleNamespace
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core import middleware
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for measuring how many presence store
+    writes active_user_middleware does per request.
+    """
+
+    help = 'Compares last seen writes per request with and without ' \
+           'write coalescing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=100000)
+        parser.add_argument('--duration', type=int, default=3600,
+                            help='Simulated time span in seconds')
+
+    def simulate(self, coalesce, users, requests, duration):
+        """ Run the middleware over a simulated request stream. """
+        rnd = random.Random(0)
+        usernames = ['user{}'.format(i) for i in range(users)]
+        step = duration / requests
+        clock = [0.0]
+        middleware._last_seen.clear()
+
+        handler = middleware.active_user_middleware(lambda request: None)
+        with override_settings(USER_ONLINE_COALESCE=coalesce), \
+                mock.patch.object(middleware, 'presence') as store, \
+                mock.patch.object(middleware.time, 'time',
+                                  lambda: clock[0]):
+            for _ in range(requests):
+                clock[0] += step
+                handler(SimpleNamespace(user=SimpleNamespace(
+                    is_authenticated=True,
+                    username=rnd.choice(usernames)
+                )))
+
+        return store.touch.call_count
+
+    def handle(self, *args, **options):
+        users = options['users']
+        requests = options['requests']
+        duration = options['duration']
+
+        for coalesce in (0, settings.USER_ONLINE_COALESCE):
+            writes = self.simulate(coalesce, users, requests, duration)
+            self.stdout.write(
+                'USER_ONLINE_COALESCE={}: {} writes, {:.4f} ops/request'
+                .format(coalesce, writes, writes / requests)
+            )
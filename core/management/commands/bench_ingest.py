@@ -0,0 +1,63 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core import ingest
+from core.models import Message, Thread
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for comparing message ingestion
+    throughput of Message.save and the write-behind buffer.
+    """
+
+    help = 'Compares messages per second of Message.save and ' \
+           'write-behind ingestion'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+
+    def save(self, thread, user, messages):
+        for i in range(messages):
+            Message(thread=thread, user=user, lang='en',
+                    text='bench message {}'.format(i)).save()
+
+    def write_behind(self, thread, user, messages):
+        buffer = ingest.get_buffer()
+        for i in range(messages):
+            buffer.add(Message(thread_id=thread.pk, user_id=user.pk,
+                               lang='en', text='bench message {}'.format(i)))
+        # Wait for the flusher thread to persist all of them.
+        while buffer.entries:
+            buffer.wakeup.set()
+            time.sleep(0.001)
+
+    def handle(self, *args, **options):
+        messages = options['messages']
+
+        user = User.objects.create_user(username='bench_ingest_user')
+        thread = Thread.objects.create(name='bench_ingest')
+        thread.users.add(user)
+        try:
+            for name, ingest_messages in (('save', self.save),
+                                          ('write-behind',
+                                           self.write_behind)):
+                started = time.perf_counter()
+                ingest_messages(thread, user, messages)
+                elapsed = time.perf_counter() - started
+                persisted = Message.objects.filter(thread=thread).count()
+                self.stdout.write(
+                    '{}: {} messages in {:.2f}s, {:.0f} messages/s, '
+                    '{} persisted'.format(
+                        name, messages, elapsed, messages / elapsed,
+                        persisted
+                    )
+                )
+                Message.objects.filter(thread=thread).delete()
+        finally:
+            thread.delete()
+            user.delete()
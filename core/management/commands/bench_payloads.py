@@ -0,0 +1,47 @@
+import json
+import timeit
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import Message
+from core.payloads import message_data
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for comparing message payload building
+    with the Django 'json' serializer and with core.payloads.
+    """
+
+    help = 'Micro-benchmark of websocket message payload building'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        message = Message(pk=1, thread_id=1, user_id=1, lang='en',
+                          text='Hello, how are you doing today?',
+                          date=timezone.now())
+
+        # Fields like nonce are not part of the payload.
+        fields = tuple(message_data(message)['fields'])
+
+        def serialize():
+            return json.loads(serializers.serialize(
+                'json', [message], fields=fields
+            )[1:-1])
+
+        def build():
+            return message_data(message)
+
+        assert serialize() == build()
+
+        for name, func in (('serializers.serialize', serialize),
+                           ('payloads.message_data', build)):
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            self.stdout.write('{}: {:.2f} us per message'.format(
+                name, seconds / number * 1000000
+            ))
@@ -0,0 +1,107 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+# What each process imports before it can serve.
+TARGETS = {
+    'asgi': 'import chat.asgi',
+    'wsgi': 'import chat.wsgi\n'
+            'from django.urls import get_resolver\n'
+            'get_resolver().url_patterns',
+    'celery': 'import django\n'
+              'django.setup()\n'
+              'from core.celery import app\n'
+              'app.loader.import_default_modules()',
+}
+
+# Modules only a built chatbot imports.
+NLP_MODULES = ('chatterbot.trainers', 'nltk', 'spacy')
+
+CHILD = '''
+import json
+import resource
+import sys
+import time
+
+NLP_MODULES = {nlp_modules!r}
+
+
+def max_rss():
+    # ru_maxrss of a child survives exec and counts the parent memory.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+started = time.perf_counter()
+{target}
+{eager}
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    'seconds': elapsed,
+    'rss': max_rss(),
+    # chatterbot itself is always imported by its Django app.
+    'chatbot': 'core.chatbot' in sys.modules
+               and sys.modules['core.chatbot']._chatbot is not None,
+    'nlp': sorted(module for module in NLP_MODULES if module in sys.modules),
+}}))
+'''
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for measuring startup time and memory of
+    the ASGI application, the WSGI application and a Celery worker, each
+    in a fresh interpreter.
+    """
+
+    help = 'Measures import time and max RSS of ASGI, WSGI and Celery ' \
+           'processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--eager-chatbot', action='store_true',
+                            help='Build the chatbot on startup, as every '
+                                 'process did before it was lazy')
+
+    def run_target(self, target, eager):
+        code = CHILD.format(
+            target=TARGETS[target],
+            nlp_modules=NLP_MODULES,
+            eager='from core.chatbot import get_chatbot\nget_chatbot()'
+            if eager else ''
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code], env=os.environ.copy(),
+            stdout=subprocess.PIPE, check=True
+        ).stdout
+        # Only the last line is ours, imports could print something.
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        for target in TARGETS:
+            results = [self.run_target(target, options['eager_chatbot'])
+                       for _ in range(options['runs'])]
+            self.stdout.write(
+                '{}: {:.0f} ms, {:.1f} MB max RSS, chatbot {}, '
+                'NLP modules: {}'.format(
+                    target,
+                    statistics.median(
+                        result['seconds'] for result in results
+                    ) * 1000,
+                    statistics.median(
+                        result['rss'] for result in results
+                    ) / 1024,
+                    'built' if results[-1]['chatbot'] else 'not built',
+                    ', '.join(results[-1]['nlp']) or 'none'
+                )
+            )
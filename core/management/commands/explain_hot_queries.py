@@ -0,0 +1,147 @@
+import datetime
+import random
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import Message, Thread, UnreadThread
+
+User = get_user_model()
+
+# Index names in PostgreSQL and SQLite plans.
+INDEX_RE = re.compile(
+    r'(?:Index (?:Only )?Scan(?: Backward)? using|Bitmap Index Scan on|'
+    r'USING (?:COVERING )?INDEX) (\w+)'
+)
+EXECUTION_TIME_RE = re.compile(r'Execution Time: ([\d.]+) ms')
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """
+    A Django management command for checking which indexes hot queries
+    use, the seeded data is rolled back.
+    """
+
+    help = 'Seeds a dataset and explains hot queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=5000)
+        parser.add_argument('--messages', type=int, default=200000)
+
+    def seed(self, users, threads, messages):
+        """ Create users, threads, messages and unread threads. """
+        rnd = random.Random(0)
+        now = timezone.now()
+
+        User.objects.bulk_create([
+            User(username='explain_hot_queries_{}'.format(i))
+            for i in range(users)
+        ])
+        Thread.objects.bulk_create([
+            Thread(name='explain_hot_queries_{}'.format(i),
+                   # Some threads have no messages yet.
+                   last_message=now - datetime.timedelta(
+                       minutes=rnd.randrange(100000)
+                   ) if i % 10 else None)
+            for i in range(threads)
+        ])
+        # Not every database backend sets ids of bulk created objects.
+        users = list(User.objects.filter(
+            username__startswith='explain_hot_queries_'
+        ).order_by('pk'))
+        threads = list(Thread.objects.filter(
+            name__startswith='explain_hot_queries_'
+        ).order_by('pk'))
+        Thread.users.through.objects.bulk_create([
+            Thread.users.through(thread_id=thread.pk, user_id=user.pk)
+            for thread in threads
+            for user in rnd.sample(users, 2)
+        ], ignore_conflicts=True)
+
+        seqs = {}
+        batch = []
+        for i in range(messages):
+            thread = rnd.choice(threads)
+            seqs[thread.pk] = seqs.get(thread.pk, 0) + 1
+            batch.append(Message(
+                thread=thread, user=rnd.choice(users), text=str(i),
+                seq=seqs[thread.pk]
+            ))
+            if len(batch) == 10000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+
+        UnreadThread.objects.bulk_create([
+            UnreadThread(thread=thread, user=user)
+            for user in users
+            for thread in rnd.sample(threads, 20)
+        ], ignore_conflicts=True)
+
+        if connection.vendor == 'postgresql':
+            # Fresh statistics for the planner.
+            with connection.cursor() as cursor:
+                for model in (User, Thread, Thread.users.through, Message,
+                              UnreadThread):
+                    cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+
+        return users[0], threads[0]
+
+    def hot_queries(self, user, thread):
+        """ Return (name, queryset) of hot queries. """
+        return [
+            ('unread threads (context processor)',
+             UnreadThread.objects.filter(user=user).order_by('-date')
+             .values_list('thread__id', 'thread__name')[:10]),
+            ('recent threads (context processor)',
+             Thread.objects.filter(users=user, last_message__isnull=False)
+             .order_by('-last_message').values_list('id', 'name')[:10]),
+            ('last messages (thread page)',
+             Message.objects.filter(thread=thread).order_by('-seq')[:50]),
+            ('message history page',
+             Message.objects.filter(thread=thread)
+             .order_by('-date', '-pk')[:50]),
+            ('messages by thread name (admin filter)',
+             Message.objects.filter(thread__name=thread.name)
+             .order_by('-pk')[:100]),
+            ('user list page',
+             User.objects.filter(username__gt=user.username)
+             .order_by('username')[:50]),
+            ('user search (prefix)',
+             User.objects.filter(username__istartswith='ex')
+             .order_by('username')[:20]),
+            ('user search (substring)',
+             User.objects.filter(username__icontains='queries_1')
+             .order_by('username')[:20]),
+        ]
+
+    def handle(self, *args, **options):
+        analyze = connection.vendor == 'postgresql'
+        try:
+            with transaction.atomic():
+                user, thread = self.seed(options['users'], options['threads'],
+                                         options['messages'])
+                for name, queryset in self.hot_queries(user, thread):
+                    plan = queryset.explain(analyze=True) if analyze \
+                        else queryset.explain()
+                    indexes = sorted(set(INDEX_RE.findall(plan)))
+                    execution_time = EXECUTION_TIME_RE.search(plan)
+                    self.stdout.write('{}: {}{}'.format(
+                        name,
+                        ', '.join(indexes) or 'no index',
+                        ' in {} ms'.format(execution_time.group(1))
+                        if execution_time else ''
+                    ))
+                    if options['verbosity'] > 1:
+                        self.stdout.write(plan)
+                raise Rollback
+        except Rollback:
+            pass
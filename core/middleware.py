@@ -1,17 +1,55 @@
-import datetime
+import threading
+import time
+from collections import OrderedDict
 
-from django.core.cache import cache
 from django.conf import settings
 
+from . import presence
+from .models import Profile
+
+# Last seen times this process wrote to the presence store.
+_last_seen = OrderedDict()
+_last_seen_lock = threading.Lock()
+
+
+def should_write(username, now):
+    """
+    Return True if the user last seen time we wrote is older than
+    USER_ONLINE_COALESCE fraction of USER_ONLINE_TIMEOUT.
+    """
+    interval = settings.USER_ONLINE_TIMEOUT * settings.USER_ONLINE_COALESCE
+    if not interval:
+        return True
+
+    with _last_seen_lock:
+        written = _last_seen.get(username)
+        if written is not None and now - written < interval:
+            return False
+
+        _last_seen[username] = now
+        _last_seen.move_to_end(username)
+        # Forget the least recently written users.
+        while len(_last_seen) > settings.USER_ONLINE_COALESCE_SIZE:
+            _last_seen.popitem(last=False)
+
+    return True
+
+
+def forget(username):
+    """ Make sure the next request of the user updates last seen time. """
+    with _last_seen_lock:
+        _last_seen.pop(username, None)
+
 
 def active_user_middleware(get_response):
 
     def middleware(request):
         """ Update user online status. """
         if request.user.is_authenticated:
-            now = datetime.datetime.now()
-            cache.set('seen_{}'.format(request.user.username), now,
-                      settings.USER_ONLINE_TIMEOUT)
+            now = time.time()
+            if should_write(request.user.username, now) and \
+                    presence.touch(request.user.username, now):
+                Profile.send_status_changes(joined=[request.user.username])
 
         return get_response(request)
 
@@ -2,16 +2,15 @@
 # Generated by Django 1.11.7 on 2017-11-15 18:09
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.db import migrations
-from django.contrib.auth import get_user_model
-
-from core.models import Profile
-
-User = get_user_model()
 
 
 class Migration(migrations.Migration):
     def add_chatbot_user(apps, schema_editor):
+        # Historical models, the current ones could have newer fields.
+        User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+        Profile = apps.get_model('core', 'Profile')
         user = User(username="chatbot", email="petryk.pjatochkin@gmail.com")
         user.save()
         profile, _ = Profile.objects.get_or_create(user=user)
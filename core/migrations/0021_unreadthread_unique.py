@@ -0,0 +1,34 @@
+# Generated by Django 3.0.9 on 2026-10-17 09:12
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def delete_duplicates(apps, schema_editor):
+    UnreadThread = apps.get_model('core', 'UnreadThread')
+
+    # Keep the oldest unread thread for each (thread, user).
+    duplicates = UnreadThread.objects.values('thread', 'user')\
+        .annotate(count=Count('id'), first_id=Min('id'))\
+        .filter(count__gt=1)
+    for row in duplicates:
+        UnreadThread.objects.filter(thread=row['thread'], user=row['user'])\
+            .exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0020_auto_20180228_1419'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates,
+                             reverse_code=migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='unreadthread',
+            unique_together={('thread', 'user')},
+        ),
+    ]
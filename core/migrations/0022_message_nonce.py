@@ -0,0 +1,18 @@
+# Generated by Django 3.0.9 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_unreadthread_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='nonce',
+            field=models.UUIDField(editable=False, null=True, unique=True),
+        ),
+    ]
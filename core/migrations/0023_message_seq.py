@@ -0,0 +1,41 @@
+# Generated by Django 3.0.9 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    Thread = apps.get_model('core', 'Thread')
+    Message = apps.get_model('core', 'Message')
+
+    # Number existing messages of each thread in the date order.
+    for thread_id in Thread.objects.values_list('id', flat=True).iterator():
+        messages = []
+        for seq, message_id in enumerate(
+            Message.objects.filter(thread_id=thread_id)
+            .order_by('date', 'id').values_list('id', flat=True), 1
+        ):
+            messages.append(Message(id=message_id, seq=seq))
+        Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+        Thread.objects.filter(id=thread_id).update(seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_message_nonce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='seq',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages,
+                             reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.9 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Altering the table in the same transaction as updating
+    # its rows fails on PostgreSQL with pending trigger events.
+
+    dependencies = [
+        ('core', '0023_message_seq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='message',
+            unique_together={('thread', 'seq')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.9 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_message_seq_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', '-date', 'id'], name='core_message_thread_date'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.9 on 2026-10-17 15:10
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build indexes without locking writes to the tables.
+    atomic = False
+
+    dependencies = [
+        ('core', '0025_message_thread_date_index'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='thread',
+            index=models.Index(condition=models.Q(last_message__isnull=False), fields=['-last_message'], name='core_thread_last_message'),
+        ),
+        AddIndexConcurrently(
+            model_name='thread',
+            index=models.Index(fields=['name'], name='core_thread_name'),
+        ),
+        AddIndexConcurrently(
+            model_name='unreadthread',
+            index=models.Index(fields=['user', '-date'], name='core_unreadthread_user_date'),
+        ),
+    ]
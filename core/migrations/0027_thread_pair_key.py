@@ -0,0 +1,46 @@
+# Generated by Django 3.0.9 on 2026-10-17 16:30
+
+from django.db import migrations, models
+
+
+def set_pair_keys(apps, schema_editor):
+    Thread = apps.get_model('core', 'Thread')
+
+    thread_users = {}
+    for thread_id, user_id in Thread.users.through.objects.values_list(
+        'thread_id', 'user_id'
+    ).iterator():
+        thread_users.setdefault(thread_id, []).append(user_id)
+
+    # Duplicated one-to-one threads could be created before, the key goes
+    # to the most recently active one.
+    threads = []
+    pair_keys = set()
+    for thread in Thread.objects.order_by(
+        models.F('last_message').desc(nulls_last=True), 'id'
+    ).only('id').iterator():
+        user_ids = thread_users.get(thread.id, [])
+        if len(user_ids) != 2:
+            continue
+        thread.pair_key = '{}:{}'.format(*sorted(user_ids))
+        if thread.pair_key not in pair_keys:
+            pair_keys.add(thread.pair_key)
+            threads.append(thread)
+    Thread.objects.bulk_update(threads, ['pair_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='pair_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(set_pair_keys,
+                             reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.9 on 2026-10-17 17:40
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Build indexes without locking writes to the table.
+    atomic = False
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('core', '0027_thread_pair_key'),
+    ]
+
+    # Expressions match the SQL of username__icontains and
+    # username__istartswith lookups.
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS core_user_username_trgm '
+            'ON auth_user USING gin (UPPER(username::text) gin_trgm_ops)',
+            'DROP INDEX CONCURRENTLY IF EXISTS core_user_username_trgm',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS core_user_username_upper '
+            'ON auth_user (UPPER(username::text) text_pattern_ops)',
+            'DROP INDEX CONCURRENTLY IF EXISTS core_user_username_upper',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.9 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+from core.tiles import geo_key
+
+
+def set_geo_keys(apps, schema_editor):
+    Profile = apps.get_model('core', 'Profile')
+    profiles = []
+    for profile in Profile.objects.filter(
+        lat__isnull=False, lon__isnull=False
+    ).only('lat', 'lon').iterator():
+        profile.geo_key = geo_key(profile.lat, profile.lon)
+        profiles.append(profile)
+    Profile.objects.bulk_update(profiles, ['geo_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='geo_key',
+            field=models.CharField(db_index=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(set_geo_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.9 on 2026-10-17 19:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_profile_geo_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
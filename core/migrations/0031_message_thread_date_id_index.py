@@ -0,0 +1,26 @@
+# Generated by Django 3.0.9 on 2026-10-17 19:30
+
+from django.contrib.postgres.operations import (AddIndexConcurrently,
+                                                RemoveIndexConcurrently)
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking writes to the messages table, the
+    # old one serves history pages until the new one is ready.
+    atomic = False
+
+    dependencies = [
+        ('core', '0030_message_date_default'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['thread', '-date', '-id'], name='core_message_thread_date_id'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='message',
+            name='core_message_thread_date',
+        ),
+    ]
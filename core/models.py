@@ -1,18 +1,20 @@
 import datetime
-import json
 
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core import serializers
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Q
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 
+from . import presence, recent, tiles, unread
+from .payloads import message_event
+
 channel_layer = get_channel_layer()
 User = get_user_model()
 
@@ -29,6 +31,15 @@ class Profile(models.Model):
     )
     lon = models.FloatField(blank=True, null=True)
     lat = models.FloatField(blank=True, null=True)
+    # Quadkey of the location for the users map tiles.
+    geo_key = models.CharField(max_length=tiles.GEO_KEY_ZOOM, null=True,
+                               editable=False, db_index=True)
+
+    def save(self, *args, **kwargs):
+        old_geo_key = tiles.set_geo_key(self, kwargs)
+        super().save(*args, **kwargs)
+        if self.geo_key != old_geo_key:
+            tiles.invalidate(old_geo_key, self.geo_key)
 
     def preview(self):
         return format_html(
@@ -55,12 +66,52 @@ class Profile(models.Model):
         return 'No location available'
 
     @staticmethod
-    def get_online_users():
+    def get_or_create_many(users):
+        """
+        Return profiles of users by user id, users should come with
+        select_related('profile'). Missing profiles are created at once.
+        """
+        profiles = {}
+        missing = []
+        for user in users:
+            try:
+                profiles[user.pk] = user.profile
+            except Profile.DoesNotExist:
+                missing.append(Profile(user=user))
+
+        if missing:
+            # Another request could create some of them meanwhile.
+            Profile.objects.bulk_create(missing, ignore_conflicts=True)
+            for profile in missing:
+                profiles[profile.user_id] = profile
+
+        return profiles
+
+    @staticmethod
+    def get_online_users(offset=0, limit=None):
         """ Return a list of usernames of online users. """
-        return [
-            key[len('seen_'):]
-            for key in cache.keys('seen_*')  # pattern is 'seen_username'
-        ]
+        return presence.online_users(offset, limit)
+
+    @staticmethod
+    def send_status_changes(joined=(), left=()):
+        """ Send user online status changes via websockets. """
+        if not joined and not left:
+            return
+
+        if settings.PRESENCE_FRIENDS_ONLY:
+            # Send changes only to friends of changed users.
+            diffs = presence.fan_out(Friend.get_friends_diffs(joined, left))
+        else:
+            diffs = {None: presence.publish(joined, left)}
+
+        for user_id, content in diffs.items():
+            async_to_sync(channel_layer.group_send)(
+                presence.group_name(user_id),
+                {
+                    'type': 'users.update',
+                    'content': content
+                }
+            )
 
     def __str__(self):
         return self.user.username
@@ -70,6 +121,22 @@ class Thread(models.Model):
     name = models.CharField(max_length=255)
     users = models.ManyToManyField(User, related_name='threads')
     last_message = models.DateTimeField(null=True)
+    # Sequence number of the last message.
+    seq = models.PositiveIntegerField(default=0, editable=False)
+    # Ordered ids of the two users of a one-to-one thread.
+    pair_key = models.CharField(max_length=64, unique=True, null=True,
+                                editable=False)
+
+    class Meta:
+        indexes = [
+            # Recent threads of a user, threads without messages are
+            # never listed so they are left out of the index.
+            models.Index(fields=['-last_message'],
+                         name='core_thread_last_message',
+                         condition=Q(last_message__isnull=False)),
+            # Admin message filter by thread name.
+            models.Index(fields=['name'], name='core_thread_name'),
+        ]
 
     def link_to_thread(self):
         if self.pk:
@@ -83,6 +150,61 @@ class Thread(models.Model):
 
     link_to_thread.short_description = 'Link to thread'
 
+    @staticmethod
+    def make_pair_key(user_id, interlocutor_id):
+        """ Return a pair key of a one-to-one thread of the users. """
+        return '{}:{}'.format(*sorted((user_id, interlocutor_id)))
+
+    @staticmethod
+    def get_or_create_pair(user, interlocutor):
+        """ Return a one-to-one thread of the users, create if needed. """
+        pair_key = Thread.make_pair_key(user.pk, interlocutor.pk)
+        thread = Thread.objects.filter(pair_key=pair_key).first()
+        if thread:
+            return thread
+
+        # Simultaneous first visits: the unique pair key makes all but
+        # one insert fail, get_or_create then returns the created thread
+        # (with its users, they are added in the same transaction).
+        with transaction.atomic():
+            thread, created = Thread.objects.get_or_create(
+                pair_key=pair_key,
+                defaults={'name': ', '.join([user.username,
+                                             interlocutor.username])}
+            )
+            if created:
+                thread.users.add(user, interlocutor)
+
+        return thread
+
+    @staticmethod
+    def reserve_seq(thread_id, date, count=1, using=None):
+        """
+        Reserve count message sequence numbers in the thread and move
+        its last message date forward to the date, return the last
+        sequence number. Locks the thread row until commit.
+        """
+        using = using or router.db_for_write(Thread)
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            # One statement for the thread row instead of an UPDATE
+            # for seq, a SELECT and an UPDATE for last_message.
+            date = connection.ops.adapt_datetimefield_value(date)
+            cursor.execute(
+                'UPDATE {0} SET seq = seq + %s, last_message = CASE '
+                'WHEN last_message IS NULL OR last_message < %s '
+                'THEN %s ELSE last_message END WHERE id = %s '
+                'RETURNING seq'.format(Thread._meta.db_table),
+                [count, date, date, thread_id]
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            raise Thread.DoesNotExist(
+                'Thread {} does not exist.'.format(thread_id)
+            )
+        return row[0]
+
     def __str__(self):
         return self.name
 
@@ -96,6 +218,14 @@ class UnreadThread(models.Model):
     )
     date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        unique_together = (('thread', 'user'),)
+        indexes = [
+            # Unread threads of a user, newest first.
+            models.Index(fields=['user', '-date'],
+                         name='core_unreadthread_user_date'),
+        ]
+
     def link_to_thread(self):
         return format_html(
             '<a href="{}">{}</a>',
@@ -105,6 +235,73 @@ class UnreadThread(models.Model):
 
     link_to_thread.short_description = 'Link to thread'
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        unread.invalidate_menu([self.user_id])
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        unread.invalidate_menu([self.user_id])
+        return result
+
+    @staticmethod
+    def mark_unread(thread_id, user_ids, date=None):
+        """
+        Create unread thread for each user, skip existing ones and users
+        who read the thread at or after the date of the message,
+        return ids of users who got the thread unread.
+        """
+        if date is not None:
+            user_ids = unread.not_read_since(thread_id, user_ids, date)
+        existing = set(UnreadThread.objects.filter(
+            thread_id=thread_id, user_id__in=user_ids
+        ).values_list('user_id', flat=True))
+        user_ids = [
+            user_id for user_id in user_ids if user_id not in existing
+        ]
+        if not user_ids:
+            return []
+
+        UnreadThread.objects.bulk_create(
+            [
+                UnreadThread(thread_id=thread_id, user_id=user_id)
+                for user_id in user_ids
+            ],
+            ignore_conflicts=True
+        )
+        if date is not None and \
+                not transaction.get_connection().in_atomic_block:
+            # A read between the check above and the insert deleted
+            # nothing, drop the rows of such users now.
+            read = set(user_ids) - set(
+                unread.not_read_since(thread_id, user_ids, date)
+            )
+            if read:
+                UnreadThread.objects.filter(
+                    thread_id=thread_id, user_id__in=read
+                ).delete()
+                user_ids = [user_id for user_id in user_ids
+                            if user_id not in read]
+        unread.invalidate_menu(user_ids)
+        transaction.on_commit(lambda: unread.send_notifications(
+            thread_id, user_ids, 'unread'
+        ))
+
+        return user_ids
+
+    @staticmethod
+    def mark_read(thread_id, user_id):
+        """ Delete unread thread of the user. """
+        # Before the delete, see mark_unread.
+        unread.remember_read(thread_id, user_id)
+        deleted, _ = UnreadThread.objects.filter(thread_id=thread_id,
+                                                 user_id=user_id).delete()
+        if deleted:
+            unread.invalidate_menu([user_id])
+            transaction.on_commit(lambda: unread.send_notifications(
+                thread_id, [user_id], 'read'
+            ))
+
     def __str__(self):
         return f'{self.thread_id}: {self.user.username}'
 
@@ -122,7 +319,20 @@ class Message(models.Model):
         choices=settings.LANGUAGES,
         default='en'
     )
-    date = models.DateTimeField(auto_now_add=True)
+    # Set by save() before the insert, the thread gets the same date.
+    date = models.DateTimeField(default=timezone.now, editable=False)
+    # Provisional id of a message saved with write-behind ingestion.
+    nonce = models.UUIDField(unique=True, null=True, editable=False)
+    # Number of the message in the thread, starts from 1.
+    seq = models.PositiveIntegerField(editable=False)
+
+    class Meta:
+        unique_together = (('thread', 'seq'),)
+        indexes = [
+            # Thread history pages, see views.thread_messages.
+            models.Index(fields=['thread', '-date', '-id'],
+                         name='core_message_thread_date_id'),
+        ]
 
     def link_to_thread(self):
         return format_html(
@@ -137,46 +347,45 @@ class Message(models.Model):
              update_fields=None):
         action = 'create' if self.pk is None else 'update'
 
-        self.thread.last_message = datetime.datetime.now()
-        self.thread.save()
-        super(Message, self).save(force_insert=False, force_update=False,
-                                  using=None, update_fields=None)
+        with transaction.atomic(using=using):
+            # Edits are not a new activity in the thread. A preset
+            # sequence number is reserved by the caller with the date.
+            if action == 'create' and self.seq is None:
+                self.date = timezone.now()
+                self.seq = Thread.reserve_seq(self.thread_id, self.date,
+                                              using=using)
+            super(Message, self).save(force_insert=force_insert,
+                                      force_update=force_update, using=using,
+                                      update_fields=update_fields)
+            if action == 'create':
+                transaction.on_commit(lambda: recent.push([self]),
+                                      using=using)
+            else:
+                transaction.on_commit(
+                    lambda: recent.invalidate(self.thread_id), using=using
+                )
 
         # Update the message in the thread via websockets.
         async_to_sync(channel_layer.group_send)(
             'thread-{}'.format(str(self.thread_id)),
             {
                 'type': 'message.update',
-                'content': {
-                    'payload': {
-                        'action': action,
-                        'data': json.loads(
-                            serializers.serialize('json', [self])[1:-1]
-                        ),
-                        'pk': self.pk
-                    }
-                }
+                'content': message_event(action, self)
             }
         )
 
     def delete(self, using=None, keep_parents=False):
-        pk = self.pk
-        thread_id = str(self.thread_id)
-
+        content = message_event('delete', self)
+        # Cached recent messages are dropped by a post_delete signal,
+        # it is sent for cascade and queryset deletes too.
         super().delete(using, keep_parents)
 
         # Delete the message from the thread via websockets.
         async_to_sync(channel_layer.group_send)(
-            'thread-{}'.format(thread_id),
+            'thread-{}'.format(str(self.thread_id)),
             {
                 'type': 'message.update',
-                'content': {
-                    'payload': {
-                        'action': 'delete',
-                        'data': {'fields': None},
-                        'pk': pk
-                    }
-                }
+                'content': content
             }
         )
 
@@ -261,6 +470,28 @@ class Friend(models.Model):
         super(Friend, self).save(force_insert=False, force_update=False,
                                  using=None, update_fields=None)
 
+    @staticmethod
+    def get_friends_usernames(user):
+        """ Return a list of usernames of the user friends. """
+        return list(Friend.objects.filter(to_user=user)
+                    .values_list('from_user__username', flat=True))
+
+    @staticmethod
+    def get_friends_diffs(joined, left):
+        """
+        Split online status changes by friends of changed users,
+        return a dict user_id -> {'joined': [...], 'left': [...]}.
+        """
+        joined = set(joined)
+        diffs = {}
+        for user_id, username in Friend.objects.filter(
+                from_user__username__in=joined.union(left)
+        ).values_list('to_user_id', 'from_user__username'):
+            diff = diffs.setdefault(user_id, {'joined': [], 'left': []})
+            diff['joined' if username in joined else 'left'].append(username)
+
+        return diffs
+
     def __str__(self):
         return "User #{} is friends with #{}".format(self.to_user_id,
                                                      self.from_user_id)
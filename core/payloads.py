@@ -0,0 +1,65 @@
+"""
+Websocket payloads of message events.
+
+Message data is built straight from the model fields in the same shape
+as the Django 'json' serializer output, so clients don't need to change.
+"""
+from django.core.serializers.json import DjangoJSONEncoder
+
+_encoder = DjangoJSONEncoder()
+
+
+def message_data(message, fields=True, pk=None):
+    """ Return message data, without fields for a deleted message. """
+    return {
+        'model': 'core.message',
+        'pk': message.pk if pk is None else pk,
+        'fields': {
+            'thread': message.thread_id,
+            'user': message.user_id,
+            'text': message.text,
+            'lang': message.lang,
+            'date': _encoder.default(message.date),
+            'seq': message.seq,
+        } if fields else None
+    }
+
+
+def message_event(action, message, pk=None):
+    """
+    Return 'message.update' content for the message,
+    pk overrides the message id (e.g. with a provisional one).
+    """
+    pk = message.pk if pk is None else pk
+    return {
+        'payload': {
+            'action': action,
+            'data': message_data(message, fields=action != 'delete', pk=pk),
+            'pk': pk
+        }
+    }
+
+
+def reconcile_event(ids):
+    """
+    Return 'message.update' content mapping provisional message ids
+    to ids and sequence numbers of the persisted messages.
+    """
+    return {
+        'payload': {
+            'action': 'reconcile',
+            'data': {'fields': ids},
+            'pk': None
+        }
+    }
+
+
+def reload_event():
+    """ Return 'message.update' content asking the client to reload. """
+    return {
+        'payload': {
+            'action': 'reload',
+            'data': {'fields': None},
+            'pk': None
+        }
+    }
@@ -0,0 +1,170 @@
+"""
+Online presence store.
+
+Last-seen times are kept in a single Redis sorted set (username scored by
+the unix time the user was last seen), so expiring stale users is a range
+removal and listing online users is a range query instead of a KEYS scan.
+
+A user is marked online by HTTP requests and by open websockets (counted
+per user, so several open tabs keep the user online until the last one is
+closed), and is dropped by sweep() USER_ONLINE_TIMEOUT seconds after being
+seen last, or USER_OFFLINE_GRACE seconds after closing the last websocket
+(so a page load doesn't send left/joined). Clients get a full snapshot
+once and then only joined/left diffs, each diff carries a version number
+so a client can detect a missed update.
+With PRESENCE_FRIENDS_ONLY each user gets only the friends' diffs in
+a per-user group and has own version number.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+PRESENCE_KEY = 'online_users'
+# Number of open websockets per user.
+CONNECTIONS_KEY = 'online_users_connections'
+# Number of the last sent diff.
+VERSION_KEY = 'online_users_version'
+# Per-user version numbers of friends-only diffs.
+VERSIONS_KEY = 'online_users_versions'
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _key(name=PRESENCE_KEY):
+    # Respect the cache key prefix and version of the 'default' cache.
+    return cache.make_key(name)
+
+
+def _cutoff(now=None):
+    return (now or time.time()) - settings.USER_ONLINE_TIMEOUT
+
+
+def touch(username, now=None):
+    """ Mark the user as seen, return True if the user just came online. """
+    return bool(_redis().zadd(_key(), {username: now or time.time()}))
+
+
+def remove(username):
+    """ Mark the user as offline, return True if the user was online. """
+    return bool(_redis().zrem(_key(), username))
+
+
+def connect(username, now=None):
+    """
+    Count a new websocket of the user and mark the user as seen,
+    return True if the user just came online.
+    """
+    pipe = _redis().pipeline()
+    pipe.hincrby(_key(CONNECTIONS_KEY), username, 1)
+    pipe.zadd(_key(), {username: now or time.time()})
+
+    return bool(pipe.execute()[-1])
+
+
+def disconnect(username, now=None):
+    """
+    Forget a closed websocket of the user, return True if it was the last
+    one: the user goes offline on a sweep after USER_OFFLINE_GRACE seconds
+    unless a websocket is opened again.
+    """
+    conn = _redis()
+    if conn.hincrby(_key(CONNECTIONS_KEY), username, -1) > 0:
+        # The user has other tabs open.
+        return False
+
+    pipe = conn.pipeline()
+    pipe.hdel(_key(CONNECTIONS_KEY), username)
+    pipe.zadd(_key(), {
+        username: _cutoff(now) + settings.USER_OFFLINE_GRACE
+    }, xx=True)
+    pipe.execute()
+    return True
+
+
+def sweep(now=None):
+    """
+    Drop users who were not seen for USER_ONLINE_TIMEOUT seconds,
+    return a list of usernames dropped by this call.
+    """
+    conn = _redis()
+    usernames = conn.zrangebyscore(_key(), '-inf', _cutoff(now))
+    if not usernames:
+        return []
+
+    pipe = conn.pipeline()
+    for username in usernames:
+        pipe.zrem(_key(), username)
+    # Websockets of such users were closed without a disconnect.
+    pipe.hdel(_key(CONNECTIONS_KEY), *usernames)
+    removed = pipe.execute()[:-1]
+
+    # Other process could drop some of them at the same time.
+    return [
+        username.decode()
+        for username, is_removed in zip(usernames, removed)
+        if is_removed
+    ]
+
+
+def online_users(offset=0, limit=None, now=None):
+    """ Return a list of usernames of online users (optionally a page). """
+    if limit is None:
+        usernames = _redis().zrangebyscore(_key(), _cutoff(now), '+inf')
+    else:
+        usernames = _redis().zrangebyscore(_key(), _cutoff(now), '+inf',
+                                           start=offset, num=limit)
+
+    return [username.decode() for username in usernames]
+
+
+def group_name(user_id=None):
+    """ Return a group name to send user online status changes to. """
+    if user_id is None:
+        return 'users'
+    return 'users-{}'.format(user_id)
+
+
+def snapshot(user_id=None, friends=None):
+    """
+    Return online users with the current version,
+    if user_id is passed - only given friends.
+    """
+    pipe = _redis().pipeline()
+    if user_id is None:
+        pipe.get(_key(VERSION_KEY))
+    else:
+        pipe.hget(_key(VERSIONS_KEY), user_id)
+    pipe.zrangebyscore(_key(), _cutoff(), '+inf')
+    version, usernames = pipe.execute()
+
+    online = {username.decode() for username in usernames}
+    if user_id is not None:
+        online &= set(friends)
+    # Chat bot is always online.
+    online.add('chatbot')
+
+    return {'version': int(version or 0), 'online': sorted(online)}
+
+
+def publish(joined=(), left=()):
+    """ Return joined/left diff with a new version number. """
+    return {
+        'version': _redis().incr(_key(VERSION_KEY)),
+        'joined': list(joined),
+        'left': list(left),
+    }
+
+
+def fan_out(diffs):
+    """ Set own version number for each user diff (user_id -> diff). """
+    pipe = _redis().pipeline()
+    for user_id in diffs:
+        pipe.hincrby(_key(VERSIONS_KEY), user_id)
+    for diff, version in zip(diffs.values(), pipe.execute()):
+        diff['version'] = version
+
+    return diffs
@@ -0,0 +1,142 @@
+"""
+Recent messages cache.
+
+The last THREAD_RECENT_MESSAGES messages of a thread are kept in a Redis
+list, newest first. New messages are pushed to the list only if it
+exists, edits and deletes drop it, a read miss fills it from the database.
+
+Every change also bumps a per-thread version, a fill is skipped if the
+version changed since the read miss, so a fill never brings back a message
+edited or deleted in the meantime. A push lost with its process leaves
+the list stale for at most THREAD_RECENT_MESSAGES_TIMEOUT.
+
+A fill with fewer messages than the list holds (the whole thread) ends
+the list with an END marker. Pushes trim the marker off once the list
+is full, so the marker is there only while the list has every message.
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+MESSAGES_KEY = 'thread_messages:{}'
+VERSION_KEY = 'thread_messages_version:{}'
+# The last entry of a list with all messages of the thread.
+END = 'end'
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _keys(thread_id):
+    # Respect the cache key prefix and version of the 'default' cache.
+    return (cache.make_key(MESSAGES_KEY.format(thread_id)),
+            cache.make_key(VERSION_KEY.format(thread_id)))
+
+
+def _dumps(message):
+    return json.dumps({
+        'pk': message.pk,
+        'user': message.user_id,
+        'text': message.text,
+        'lang': message.lang,
+        # Exact date, it is a part of history cursors.
+        'date': message.date.isoformat(),
+        'seq': message.seq,
+    })
+
+
+def _loads(thread_id, raw):
+    from .models import Message
+
+    data = json.loads(raw)
+    return Message(pk=data['pk'], thread_id=thread_id, user_id=data['user'],
+                   text=data['text'], lang=data['lang'],
+                   date=parse_datetime(data['date']), seq=data['seq'])
+
+
+def get(thread_id):
+    """
+    Return (messages, complete, version), messages are newest first or
+    None on a miss, complete is True if they are all thread messages.
+    Pass the version to fill() after a miss.
+    """
+    messages_key, version_key = _keys(thread_id)
+    pipe = _redis().pipeline()
+    pipe.get(version_key)
+    pipe.lrange(messages_key, 0, -1)
+    version, raw_messages = pipe.execute()
+    if not raw_messages:
+        return None, False, version
+
+    complete = raw_messages[-1] == END.encode()
+    if complete:
+        raw_messages = raw_messages[:-1]
+    messages = []
+    seen = set()
+    for raw in raw_messages:
+        message = _loads(thread_id, raw)
+        # Just in case, push() drops a message a fill already has.
+        if message.pk not in seen:
+            seen.add(message.pk)
+            messages.append(message)
+    messages.sort(key=lambda message: message.seq, reverse=True)
+
+    return messages, complete, version
+
+
+def fill(thread_id, messages, version):
+    """
+    Cache the last messages (newest first) unless they changed, fewer
+    messages than THREAD_RECENT_MESSAGES are the whole thread.
+    """
+    messages_key, version_key = _keys(thread_id)
+    entries = [_dumps(message)
+               for message in messages[:settings.THREAD_RECENT_MESSAGES]]
+    if not entries:
+        return
+    if len(entries) < settings.THREAD_RECENT_MESSAGES:
+        entries.append(END)
+
+    with _redis().pipeline() as pipe:
+        try:
+            pipe.watch(version_key)
+            if pipe.get(version_key) != version:
+                return
+            pipe.multi()
+            pipe.delete(messages_key)
+            pipe.rpush(messages_key, *entries)
+            pipe.expire(messages_key, settings.THREAD_RECENT_MESSAGES_TIMEOUT)
+            pipe.execute()
+        except WatchError:
+            # Thread messages changed since the database read.
+            pass
+
+
+def push(messages):
+    """ Add new messages to cached lists of their threads. """
+    pipe = _redis().pipeline()
+    for message in messages:
+        messages_key, version_key = _keys(message.thread_id)
+        pipe.incr(version_key)
+        pipe.expire(version_key, settings.THREAD_RECENT_MESSAGES_TIMEOUT)
+        entry = _dumps(message)
+        # A fill after the commit could have the message already.
+        pipe.lrem(messages_key, 0, entry)
+        pipe.lpushx(messages_key, entry)
+        pipe.ltrim(messages_key, 0, settings.THREAD_RECENT_MESSAGES - 1)
+    pipe.execute()
+
+
+def invalidate(thread_id):
+    """ Drop cached messages of the thread. """
+    messages_key, version_key = _keys(thread_id)
+    pipe = _redis().pipeline()
+    pipe.incr(version_key)
+    pipe.expire(version_key, settings.THREAD_RECENT_MESSAGES_TIMEOUT)
+    pipe.delete(messages_key)
+    pipe.execute()
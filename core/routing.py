@@ -3,7 +3,7 @@ from django.conf.urls import url
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 
-from .consumers import WsUsers, WsThread
+from .consumers import WsNotifications, WsUsers, WsThread
 
 
 chat = ProtocolTypeRouter({
@@ -11,6 +11,7 @@ chat = ProtocolTypeRouter({
         URLRouter([
             url(r"^ws/users/$", WsUsers),
             url(r"^ws/thread/(?P<thread>\w+)$", WsThread),
+            url(r"^ws/notifications/$", WsNotifications),
         ])
     ),
 })
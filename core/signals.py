@@ -1,16 +1,23 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
 from django.contrib.auth import user_logged_in, user_logged_out
-from django.contrib.gis.geoip2 import GeoIP2
-from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
 from django.dispatch import receiver
 
-from .models import Profile
+from . import geo, presence, recent, unread
+from .middleware import forget
+from .models import Message, Profile, Thread
+
+channel_layer = get_channel_layer()
 
 
 def get_client_ip(request):
     """ Get user ip. """
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
+        ip = x_forwarded_for.split(',')[0].strip()
     else:
         ip = request.META.get('REMOTE_ADDR')
     return ip
@@ -18,16 +25,23 @@ def get_client_ip(request):
 
 @receiver(user_logged_in)
 def on_user_loggedin(sender, user, request, **kwargs):
-    """ Update user coordinates if they are empty. """
+    """ Mark user online and update coordinates if they are empty. """
     if user.is_authenticated:
+        if presence.touch(user.username):
+            Profile.send_status_changes(joined=[user.username])
+
         # If there no user profile - create it.
         profile, _ = Profile.objects.get_or_create(user=user)
 
         ip = get_client_ip(request)
-        if ip and ip != '127.0.0.1' and not all([profile.lon, profile.lat]):
-            g = GeoIP2()
-            profile.lon, profile.lat = g.lon_lat(ip)
-            profile.save()
+        if geo.is_public(ip) and \
+                (profile.lon is None or profile.lat is None):
+            from .tasks import update_profile_location
+
+            # Look the location up out of the login request.
+            transaction.on_commit(
+                lambda: update_profile_location.delay(user.pk, ip)
+            )
 
 
 @receiver(user_logged_out)
@@ -35,4 +49,75 @@ def on_user_logout(sender, **kwargs):
     """ Update user online status. """
     user = kwargs.get('user')
     if user.is_authenticated:
-        cache.delete('seen_{}'.format(user.username))
+        forget(user.username)
+        if presence.remove(user.username):
+            Profile.send_status_changes(left=[user.username])
+
+
+def send_thread_members_changed(thread_ids):
+    """ Ask thread websockets to reload thread members. """
+    for thread_id in thread_ids:
+        async_to_sync(channel_layer.group_send)(
+            'thread-{}'.format(str(thread_id)),
+            {'type': 'thread.members'}
+        )
+
+
+def release_pair_keys(thread_ids):
+    """
+    Forget pair keys of threads which are not one-to-one threads
+    of the pair anymore.
+    """
+    for thread in Thread.objects.filter(pk__in=thread_ids,
+                                        pair_key__isnull=False):
+        user_ids = list(thread.users.values_list('pk', flat=True))
+        if len(user_ids) == 1:
+            # A thread with oneself.
+            user_ids *= 2
+        if len(user_ids) != 2 or \
+                Thread.make_pair_key(*user_ids) != thread.pair_key:
+            Thread.objects.filter(pk=thread.pk).update(pair_key=None)
+
+
+@receiver(post_delete, sender=Message)
+def on_message_deleted(sender, instance, using, **kwargs):
+    """ Drop cached recent messages of the thread. """
+    thread_id = instance.thread_id
+    transaction.on_commit(lambda: recent.invalidate(thread_id), using=using)
+
+
+@receiver(m2m_changed, sender=Thread.users.through)
+def on_thread_users_changed(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """ Refresh thread members cached by websockets and users menus. """
+    if reverse:
+        # instance is a user.
+        if action == 'pre_clear':
+            # Remember user threads, we will need them after the clear.
+            instance.cleared_thread_ids = list(
+                instance.threads.values_list('pk', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('cleared_thread_ids', [])
+        thread_ids = pk_set
+        user_ids = [instance.pk]
+    else:
+        if action == 'pre_clear':
+            instance.cleared_user_ids = list(
+                instance.users.values_list('pk', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('cleared_user_ids', [])
+        thread_ids = [instance.pk]
+        user_ids = pk_set
+
+    if action in ('post_add', 'post_remove', 'post_clear') and thread_ids:
+        thread_ids = list(thread_ids)
+        release_pair_keys(thread_ids)
+        # Users could get or lose threads in the menu.
+        unread.invalidate_menu(list(user_ids or []))
+        transaction.on_commit(
+            lambda: send_thread_members_changed(thread_ids)
+        )
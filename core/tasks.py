@@ -1,53 +1,66 @@
-import datetime
-import langid
+from celery import shared_task
 
-from celery import Celery, shared_task
-from chatterbot import ChatBot
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-
-from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
-
-from .models import Profile, Message
+from django.utils.dateparse import parse_datetime
 
-app = Celery('chat')
+from . import chatbot, geo, language, presence
+from .models import Message, Profile, UnreadThread
 
-channel_layer = get_channel_layer()
 User = get_user_model()
 
-chatbot = ChatBot(**settings.CHATTERBOT)
-langid.set_languages([code for code, _ in settings.LANGUAGES])
-
-
-@app.task
-def update_user_statuses():
-    """ Task to update user online statuses via websockets. """
-    # Chat bot is always online.
-    now = datetime.datetime.now()
-    cache.set('seen_chatbot', now, settings.USER_ONLINE_TIMEOUT)
-
-    async_to_sync(channel_layer.group_send)(
-        'users',
-        {
-            'type': 'users.update',
-            'content': Profile.get_online_users()
-        }
-    )
-
 
 @shared_task
 def chatbot_response(thread_id, text):
     """ Task to send a response from Chatbot. """
     chatbot_user = User.objects.get(username='chatbot')
 
-    response = str(chatbot.get_response(text))
+    response = chatbot.get_response(text)
 
     message = Message(
         thread_id=thread_id,
         user=chatbot_user,
         text=response
     )
-    message.lang, _ = langid.classify(message.text)
+    message.lang = language.detect(message.text)
     message.save()
+
+
+@shared_task
+def mark_thread_unread(thread_id, user_ids, date=None):
+    """
+    Task to create unread threads for members of a big thread, users who
+    read the thread since the message date (ISO 8601) are skipped.
+    """
+    UnreadThread.mark_unread(
+        thread_id, user_ids, parse_datetime(date) if date else None
+    )
+
+
+@shared_task
+def sweep_presence():
+    """ Task to send 'left' for users who went offline. """
+    Profile.send_status_changes(left=presence.sweep())
+
+
+@shared_task
+def detect_messages_lang(message_ids):
+    """ Task to detect languages of sent messages. """
+    messages = list(Message.objects.filter(pk__in=message_ids))
+    langs = language.detect_many([message.text for message in messages])
+    for message, lang in zip(messages, langs):
+        if message.lang != lang:
+            message.lang = lang
+            message.save(update_fields=['lang'])
+
+
+@shared_task
+def update_profile_location(user_id, ip):
+    """ Task to set an empty user location by the IP. """
+    location = geo.lon_lat(ip)
+    if location is None:
+        return
+
+    profile, _ = Profile.objects.get_or_create(user_id=user_id)
+    if profile.lon is None or profile.lat is None:
+        profile.lon, profile.lat = location
+        profile.save(update_fields=['lon', 'lat'])
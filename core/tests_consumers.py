@@ -0,0 +1,142 @@
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from . import presence, unread
+from .models import Message, Thread, UnreadThread
+from .routing import chat
+
+
+class ChatConsumersTest(TransactionTestCase):
+    def setUp(self):
+        self.test_user = User.objects.create_user(username='testuser',
+                                                  password='12345')
+        self.test_user2 = User.objects.create_user(username='testuser2',
+                                                   password='12345')
+        self.thread = Thread.objects.create(name='Test thread')
+        self.thread.users.add(self.test_user)
+
+    @async_to_sync
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            chat, '/ws/thread/{}'.format(self.thread.pk)
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+
+        return connected
+
+    def test_consumers_thread_members(self):
+        self.assertTrue(self.connect(self.test_user))
+        # Only thread members can connect.
+        self.assertFalse(self.connect(self.test_user2))
+
+        self.thread.users.add(self.test_user2)
+        self.assertTrue(self.connect(self.test_user2))
+
+    def test_consumers_thread_presence(self):
+        user = User.objects.create_user(username='presence_user')
+        self.thread.users.add(user)
+        self.addCleanup(presence.remove, user.username)
+        with mock.patch('core.consumers.sweep_presence') as sweep_presence:
+            self.assertTrue(self.connect(user))
+        # The user goes offline shortly after the last socket is closed.
+        sweep_presence.apply_async.assert_called_once_with(
+            countdown=settings.USER_OFFLINE_GRACE
+        )
+        self.assertIn(user.username, presence.online_users())
+        self.assertIn(user.username, presence.sweep(
+            time.time() + settings.USER_OFFLINE_GRACE
+        ))
+
+    @async_to_sync
+    async def remove_while_connected(self, user):
+        communicator = WebsocketCommunicator(
+            chat, '/ws/thread/{}'.format(self.thread.pk)
+        )
+        communicator.scope['user'] = user
+        await communicator.connect()
+        await database_sync_to_async(self.thread.users.remove)(user)
+        output = await communicator.receive_output()
+        await communicator.wait()
+
+        return output
+
+    def test_consumers_thread_members_changed(self):
+        # The socket is closed when the user is removed from the thread.
+        output = self.remove_while_connected(self.test_user)
+        self.assertEqual(output['type'], 'websocket.close')
+
+    @async_to_sync
+    async def resume(self, user, seq):
+        communicator = WebsocketCommunicator(
+            chat, '/ws/thread/{}'.format(self.thread.pk)
+        )
+        communicator.scope['user'] = user
+        await communicator.connect()
+        await communicator.send_json_to({'resume': seq})
+        events = []
+        while not await communicator.receive_nothing():
+            events.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+
+        return events
+
+    @override_settings(THREAD_RESUME_LIMIT=2)
+    def test_consumers_thread_resume(self):
+        for text in ('Hello', 'How are you?', 'Bye'):
+            Message(thread=self.thread, user=self.test_user, text=text).save()
+
+        # Only missed messages are sent.
+        events = self.resume(self.test_user, 1)
+        self.assertEqual(
+            [(event['payload']['action'],
+              event['payload']['data']['fields']['seq'])
+             for event in events],
+            [('create', 2), ('create', 3)]
+        )
+
+        # Too many missed messages - the client should reload.
+        events = self.resume(self.test_user, 0)
+        self.assertEqual([event['payload']['action'] for event in events],
+                         ['reload'])
+
+    @async_to_sync
+    async def notifications(self, user, thread_id):
+        communicator = WebsocketCommunicator(chat, '/ws/notifications/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        events = [await communicator.receive_json_from()]
+        await database_sync_to_async(UnreadThread.mark_unread)(
+            thread_id, [user.pk]
+        )
+        events.append(await communicator.receive_json_from())
+        # Already unread - nothing is sent.
+        await database_sync_to_async(UnreadThread.mark_unread)(
+            thread_id, [user.pk]
+        )
+        await database_sync_to_async(UnreadThread.mark_read)(
+            thread_id, user.pk
+        )
+        events.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+
+        return events
+
+    def test_consumers_notifications(self):
+        unread.invalidate_menu([self.test_user.pk])
+        self.addCleanup(unread.invalidate_menu, [self.test_user.pk])
+        events = self.notifications(self.test_user, self.thread.pk)
+        self.assertEqual(
+            [(event['action'], event['unread_threads']) for event in events],
+            [('menu', 0), ('unread', 1), ('read', 0)]
+        )
+        self.assertEqual(events[1]['threads'],
+                         [{'id': self.thread.pk, 'name': 'Test thread'}])
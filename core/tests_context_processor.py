@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 from django.urls import reverse
 
+from . import unread
 from .context_processors import unread_threads
 from .models import Thread, UnreadThread
 
@@ -11,13 +12,16 @@ from .models import Thread, UnreadThread
 class ChatContextProcessorTest(TestCase):
     def setUp(self):
         # No need to set cache seen for test user.
-        patcher_cache = mock.patch('core.middleware.cache')
+        patcher_cache = mock.patch('core.middleware.presence')
         self.mock_cache = patcher_cache.start()
         self.addCleanup(patcher_cache.stop)
         # Create usual user.
         self.test_user = User.objects.create_user(username='testuser',
                                                   password='12345')
         self.test_user.save()
+        # Note: We don't have separate cache for tests.
+        unread.invalidate_menu([self.test_user.pk])
+        self.addCleanup(unread.invalidate_menu, [self.test_user.pk])
 
     def test_context_processor_unread_threads(self):
         # Anonymous user.
@@ -45,3 +49,26 @@ class ChatContextProcessorTest(TestCase):
         result = unread_threads(request)
         self.assertEqual(result['unread_threads'], 1)
         self.assertEqual(len(result['threads']), 1)
+
+    def test_context_processor_unread_threads_cached(self):
+        thread = Thread.objects.create(name='Test thread')
+        thread.users.add(self.test_user)
+        UnreadThread.mark_unread(thread.pk, [self.test_user.pk])
+        self.client.login(username='testuser', password='12345')
+        request = self.client.get(reverse('core:user_list')).wsgi_request
+
+        # Nothing is read until a template uses it.
+        with self.assertNumQueries(0):
+            result = unread_threads(request)
+        self.assertEqual(result['unread_threads'], 1)
+        # Then it comes from the cache.
+        with self.assertNumQueries(0):
+            result = unread_threads(request)
+            self.assertEqual(list(result['threads']),
+                             [{'id': thread.pk, 'name': 'Test thread'}])
+
+        # Reading the thread drops the cached menu.
+        UnreadThread.mark_read(thread.pk, self.test_user.pk)
+        result = unread_threads(request)
+        self.assertEqual(result['unread_threads'], 0)
+        self.assertEqual(list(result['threads']), [])
@@ -0,0 +1,21 @@
+from django.test import SimpleTestCase, override_settings
+
+from . import language
+
+
+class ChatLanguageTest(SimpleTestCase):
+    def test_language_detect(self):
+        self.assertEqual(language.detect('Hello, how are you doing today?'),
+                         'en')
+        self.assertEqual(language.detect('Hola, ¿cómo estás hoy?'), 'es')
+
+    @override_settings(LANG_DETECT_DEFAULT='fr', LANG_DETECT_MIN_LENGTH=4)
+    def test_language_detect_short(self):
+        # Too short text to detect a language.
+        self.assertEqual(language.detect(' Ok '), 'fr')
+
+    def test_language_detect_many(self):
+        texts = ['Hello, how are you doing today?', 'Hola, ¿cómo estás hoy?',
+                 'Hello, how are you  doing today?']
+        self.assertEqual(language.detect_many(texts),
+                         [language.detect(text) for text in texts])
@@ -0,0 +1,33 @@
+from django.test import TestCase, override_settings
+
+from . import middleware
+
+
+@override_settings(USER_ONLINE_TIMEOUT=120, USER_ONLINE_COALESCE=0.25,
+                   USER_ONLINE_COALESCE_SIZE=2)
+class ChatMiddlewareTest(TestCase):
+    def setUp(self):
+        middleware._last_seen.clear()
+
+    def test_middleware_should_write(self):
+        self.assertTrue(middleware.should_write('testuser', 1000))
+        # The last seen time is fresh - skip the write.
+        self.assertFalse(middleware.should_write('testuser', 1029))
+        self.assertTrue(middleware.should_write('testuser', 1030))
+
+        # After logout next request writes again.
+        middleware.forget('testuser')
+        self.assertTrue(middleware.should_write('testuser', 1031))
+
+    def test_middleware_should_write_size(self):
+        middleware.should_write('testuser1', 1000)
+        middleware.should_write('testuser2', 1000)
+        middleware.should_write('testuser3', 1000)
+        self.assertEqual(len(middleware._last_seen), 2)
+        # The least recently written user was forgotten.
+        self.assertTrue(middleware.should_write('testuser1', 1001))
+
+    @override_settings(USER_ONLINE_COALESCE=0)
+    def test_middleware_should_write_disabled(self):
+        self.assertTrue(middleware.should_write('testuser', 1000))
+        self.assertTrue(middleware.should_write('testuser', 1000))
@@ -1,9 +1,23 @@
+import datetime
+import json
+import time
+import uuid
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core import serializers
 from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from .models import Profile
+from . import (chatbot, geo, ingest, language, payloads, presence, recent,
+               tiles, unread)
+from .models import Friend, Message, Profile, Thread, UnreadThread
+from .tasks import update_profile_location
 
 
 class ChatModelTest(TestCase):
@@ -49,6 +63,483 @@ class ChatModelTest(TestCase):
         self.assertIn('test_model_user1', result)
         self.assertIn('test_model_user2', result)
 
-        # Clean up the cache.
-        cache.delete('seen_{}'.format('test_model_user1'))
-        cache.delete('seen_{}'.format('test_model_user2'))
+        # Clean up the presence store.
+        presence.remove('test_model_user1')
+        presence.remove('test_model_user2')
+
+    def test_models_profile_geo_key(self):
+        self.assertEqual(tiles.quadkey(3, 5, 3), '213')
+        self.assertEqual(tiles.tile_xy(0, 0, 1), (1, 1))
+
+        profile = Profile.objects.create(user=self.user_bob,
+                                         lat=51.5, lon=-0.12)
+        self.assertEqual(len(profile.geo_key), tiles.GEO_KEY_ZOOM)
+        self.assertEqual(profile.geo_key[:5],
+                         tiles.quadkey(*tiles.tile_xy(51.5, -0.12, 5), 5))
+        old_geo_key = profile.geo_key
+        self.addCleanup(tiles.invalidate, old_geo_key)
+
+        # Cached tiles with the old location are dropped on a move.
+        tiles.get([old_geo_key[:2]])
+        self.assertIsNotNone(
+            cache.get(tiles.TILE_KEY.format(old_geo_key[:2]))
+        )
+        profile.lat, profile.lon = 48.85, 2.35
+        profile.save(update_fields=['lat', 'lon'])
+        self.addCleanup(tiles.invalidate, profile.geo_key)
+        self.assertIsNone(cache.get(tiles.TILE_KEY.format(old_geo_key[:2])))
+        profile.refresh_from_db()
+        self.assertNotEqual(profile.geo_key, old_geo_key)
+
+        profile.lat = None
+        profile.save()
+        self.assertIsNone(profile.geo_key)
+
+    @mock.patch('core.geo.get_geoip')
+    def test_models_profile_location(self, get_geoip):
+        geo.lon_lat.cache_clear()
+        self.addCleanup(geo.lon_lat.cache_clear)
+        get_geoip.return_value.lon_lat.return_value = (-0.12, 51.5)
+
+        # Login doesn't wait for GeoIP, the lookup is queued on commit.
+        self.addCleanup(presence.remove, 'test_model_user1')
+        callbacks = []
+        with mock.patch('django.db.transaction.on_commit',
+                        lambda func, using=None: callbacks.append(func)), \
+                mock.patch('core.tasks.update_profile_location.delay') \
+                as delay:
+            resp = self.client.post(
+                reverse('core:login'),
+                {'username': 'test_model_user1', 'password': '12345'},
+                HTTP_X_FORWARDED_FOR='8.8.8.8'
+            )
+            self.assertRedirects(resp, reverse('core:user_list'))
+            delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        delay.assert_called_once_with(self.user_bob.pk, '8.8.8.8')
+        get_geoip.assert_not_called()
+
+        self.assertIsNone(geo.lon_lat('127.0.0.1'))
+        self.assertIsNone(geo.lon_lat('example.com'))
+        update_profile_location(self.user_bob.pk, '8.8.8.8')
+        update_profile_location(self.user_steve.pk, '8.8.8.8')
+        # The reader is asked once per IP.
+        get_geoip.return_value.lon_lat.assert_called_once_with('8.8.8.8')
+        profile = Profile.objects.get(user=self.user_bob)
+        self.assertEqual((profile.lon, profile.lat), (-0.12, 51.5))
+        self.addCleanup(tiles.invalidate, profile.geo_key)
+
+        # A known location is kept.
+        get_geoip.return_value.lon_lat.return_value = (2.35, 48.85)
+        update_profile_location(self.user_bob.pk, '1.1.1.1')
+        profile.refresh_from_db()
+        self.assertEqual((profile.lon, profile.lat), (-0.12, 51.5))
+
+    @mock.patch('core.chatbot._chatbot', None)
+    def test_models_chatbot_lazy(self):
+        with mock.patch('chatterbot.ChatBot') as chatbot_class:
+            self.assertIs(chatbot.get_chatbot(), chatbot.get_chatbot())
+        # Built once, on the first use.
+        chatbot_class.assert_called_once_with(**settings.CHATTERBOT)
+
+    def test_models_chatbot_response_cache(self):
+        responses = chatbot.ResponseCache(max_size=2, timeout=10)
+        self.assertIsNone(responses.get('hi', now=0))
+        responses.set('hi', 'Hello', now=0)
+        responses.set('2 + 2', '4', permanent=True, now=0)
+        self.assertEqual(responses.get('hi', now=5), 'Hello')
+        self.assertIsNone(responses.get('hi', now=10))
+        self.assertEqual(responses.get('2 + 2', now=1000), '4')
+
+        # The least recently used response is evicted.
+        responses.set('a', 'A', now=1000)
+        responses.get('2 + 2', now=1000)
+        responses.set('b', 'B', now=1000)
+        self.assertIsNone(responses.get('a', now=1000))
+        self.assertEqual(responses.stats(),
+                         {'hits': 3, 'misses': 3, 'size': 2})
+
+    def test_models_chatbot_get_response(self):
+        class Statement:
+            def __init__(self, text, **kwargs):
+                self.text = text
+                self.fields = kwargs
+                self.conversation = kwargs.get('conversation')
+
+            def serialize(self):
+                return dict(self.fields, text=self.text)
+
+        class MathematicalEvaluation:
+            def can_process(self, statement):
+                return statement.text.startswith('What is')
+
+            def process(self, statement):
+                return mock.Mock(confidence=1, __str__=lambda _: '4')
+
+        def strip(statement):
+            return Statement(statement.text.strip())
+
+        bot = mock.Mock(logic_adapters=[MathematicalEvaluation()],
+                        preprocessors=[strip], read_only=False)
+        bot.name = 'Chat Bot'
+        bot.get_response.return_value = 'Hello'
+        responses = chatbot.ResponseCache(max_size=10, timeout=10)
+        conversation = mock.Mock(Statement=Statement)
+        with mock.patch('core.chatbot.get_chatbot', return_value=bot), \
+                mock.patch('core.chatbot.responses', responses), \
+                mock.patch.dict('sys.modules',
+                                {'chatterbot.conversation': conversation}):
+            self.assertEqual(chatbot.get_response('Hello there'), 'Hello')
+            # Inputs are normalised.
+            self.assertEqual(chatbot.get_response(' hello  THERE'), 'Hello')
+            bot.get_response.assert_called_once_with('Hello there')
+            # A cached response is learned as ChatBot.get_response does.
+            self.assertEqual(bot.learn_response.call_args[0][0].text,
+                             'hello  THERE')
+            bot.storage.create.assert_called_with(
+                text='Hello', in_response_to='hello  THERE',
+                conversation=None, persona='bot:Chat Bot'
+            )
+
+            # Adapters get preprocessed input.
+            self.assertEqual(chatbot.get_response(' What is 2 + 2'), '4')
+            bot.storage.create.assert_called_with(
+                text='4', in_response_to='What is 2 + 2',
+                conversation=None, persona='bot:Chat Bot'
+            )
+            self.assertEqual(responses.stats(),
+                             {'hits': 1, 'misses': 2, 'size': 2})
+            key = (language.detect(' What is 2 + 2'), 'what is 2 + 2')
+        # Deterministic answers never expire.
+        self.assertIsNone(responses.entries[key][1])
+        self.assertEqual(bot.get_response.call_count, 1)
+
+        # Read only chatbots don't learn.
+        bot.read_only = True
+        bot.learn_response.reset_mock()
+        with mock.patch('core.chatbot.get_chatbot', return_value=bot), \
+                mock.patch('core.chatbot.responses', responses), \
+                mock.patch.dict('sys.modules',
+                                {'chatterbot.conversation': conversation}):
+            self.assertEqual(chatbot.get_response('Hello there'), 'Hello')
+        bot.learn_response.assert_not_called()
+
+    def test_models_profile_online_users_expire(self):
+        now = time.time()
+        presence.touch('test_model_user1', now)
+        presence.touch('test_model_user2',
+                       now - settings.USER_ONLINE_TIMEOUT - 1)
+
+        # Stale users are dropped from the index.
+        result = Profile.get_online_users()
+        self.assertIn('test_model_user1', result)
+        self.assertNotIn('test_model_user2', result)
+
+        # Get a page of online users.
+        presence.touch('test_model_user2', now + 1)
+        result = Profile.get_online_users(limit=1)
+        self.assertEqual(len(result), 1)
+
+        # Clean up the presence store.
+        presence.remove('test_model_user1')
+        presence.remove('test_model_user2')
+        self.assertNotIn('test_model_user1', Profile.get_online_users())
+
+    def test_models_profile_online_users_connections(self):
+        # Two tabs are opened.
+        self.assertTrue(presence.connect('test_model_user1'))
+        self.assertFalse(presence.connect('test_model_user1'))
+        self.assertIn('test_model_user1', presence.snapshot()['online'])
+
+        # The user stays online after the last tab is closed (it could be
+        # a page load) for USER_OFFLINE_GRACE seconds.
+        self.assertFalse(presence.disconnect('test_model_user1'))
+        self.assertTrue(presence.disconnect('test_model_user1'))
+        self.assertIn('test_model_user1', Profile.get_online_users())
+        self.assertNotIn('test_model_user1', presence.sweep())
+        # A reopened tab keeps the user online.
+        self.assertFalse(presence.connect('test_model_user1'))
+        self.assertNotIn('test_model_user1', presence.sweep(
+            time.time() + settings.USER_OFFLINE_GRACE
+        ))
+        self.assertTrue(presence.disconnect('test_model_user1'))
+        self.assertIn('test_model_user1', presence.sweep(
+            time.time() + settings.USER_OFFLINE_GRACE
+        ))
+        self.assertNotIn('test_model_user1', Profile.get_online_users())
+
+        # Users who stopped pinging are dropped.
+        presence.connect('test_model_user2',
+                         time.time() - settings.USER_ONLINE_TIMEOUT - 1)
+        self.assertIn('test_model_user2', presence.sweep())
+        self.assertNotIn('test_model_user2', presence.sweep())
+
+        version = presence.snapshot()['version']
+        diff = presence.publish(left=['test_model_user2'])
+        self.assertEqual(diff['version'], version + 1)
+
+    def test_models_friends_diffs(self):
+        user_alice = User.objects.create_user(username='test_model_user3',
+                                              password='12345')
+        Friend.objects.create(from_user=self.user_bob, to_user=self.user_steve)
+        Friend.objects.create(from_user=self.user_steve, to_user=self.user_bob)
+
+        self.assertEqual(Friend.get_friends_usernames(self.user_bob),
+                         ['test_model_user2'])
+
+        # Only friends of changed users get the changes.
+        diffs = Friend.get_friends_diffs(['test_model_user1'],
+                                         ['test_model_user3'])
+        self.assertEqual(diffs, {
+            self.user_steve.pk: {'joined': ['test_model_user1'], 'left': []}
+        })
+        self.assertNotIn(user_alice.pk, diffs)
+
+        diffs = presence.fan_out(diffs)
+        version = diffs[self.user_steve.pk]['version']
+        result = presence.snapshot(self.user_steve.pk, ['test_model_user1'])
+        self.assertEqual(result['version'], version)
+        # Chat bot is always online.
+        self.assertIn('chatbot', result['online'])
+
+    def test_models_unread_thread_mark_unread(self):
+        thread = Thread.objects.create(name='Test thread')
+        UnreadThread.objects.create(thread=thread, user=self.user_bob)
+
+        # Existing unread threads are skipped.
+        UnreadThread.mark_unread(thread.pk, [self.user_bob.pk,
+                                             self.user_steve.pk])
+        self.assertEqual(UnreadThread.objects.filter(thread=thread).count(), 2)
+
+    def test_models_unread_thread_read_before_task(self):
+        thread = Thread.objects.create(name='Test thread')
+        sent = timezone.now()
+        # Bob read the message before the deferred mark_unread.
+        UnreadThread.mark_read(thread.pk, self.user_bob.pk)
+        self.addCleanup(cache.delete_many, [
+            unread.READ_KEY.format(thread.pk, user.pk)
+            for user in (self.user_bob, self.user_steve)
+        ])
+
+        self.assertEqual(
+            UnreadThread.mark_unread(
+                thread.pk, [self.user_bob.pk, self.user_steve.pk], sent
+            ),
+            [self.user_steve.pk]
+        )
+        # Reads of older messages don't count.
+        self.assertEqual(
+            UnreadThread.mark_unread(thread.pk, [self.user_bob.pk],
+                                     timezone.now()),
+            [self.user_bob.pk]
+        )
+
+    def test_models_message_payload(self):
+        thread = Thread.objects.create(name='Test thread')
+        message = Message(thread=thread, user=self.user_bob, text='Hello')
+        message.save()
+
+        # Payload has the same shape as the Django serializer output.
+        self.assertEqual(
+            payloads.message_data(message),
+            json.loads(serializers.serialize(
+                'json', [message],
+                fields=('thread', 'user', 'text', 'lang', 'date', 'seq')
+            )[1:-1])
+        )
+        self.assertIsNone(payloads.message_data(message, False)['fields'])
+
+    def test_models_message_thread_last_message(self):
+        thread = Thread.objects.create(name='Test thread')
+        message = Message(thread=thread, user=self.user_bob, text='Hello')
+        message.save()
+        thread.refresh_from_db()
+        self.assertEqual(thread.last_message, message.date)
+
+        # Edits are not a new activity.
+        last_message = message.date - datetime.timedelta(days=1)
+        Thread.objects.filter(pk=thread.pk).update(last_message=last_message)
+        message.text = 'Hello!'
+        message.save()
+        thread.refresh_from_db()
+        self.assertEqual(thread.last_message, last_message)
+
+    def test_models_message_seq(self):
+        thread = Thread.objects.create(name='Test thread')
+        for text in ('Hello', 'Hi'):
+            Message(thread=thread, user=self.user_bob, text=text).save()
+        message = Message.objects.get(thread=thread, text='Hi')
+        self.assertEqual(message.seq, 2)
+
+        # Edits and deletes don't change sequence numbers.
+        message.text = 'Hi!'
+        message.save()
+        Message.objects.get(thread=thread, text='Hello').delete()
+        Message(thread=thread, user=self.user_bob, text='Bye').save()
+        self.assertEqual(
+            list(Message.objects.filter(thread=thread)
+                 .order_by('seq').values_list('seq', flat=True)),
+            [2, 3]
+        )
+        thread.refresh_from_db()
+        self.assertEqual(thread.seq, 3)
+
+        # One statement updates the thread row.
+        with CaptureQueriesContext(connection) as queries:
+            message = Message(thread=thread, user=self.user_bob, text='Hey')
+            message.save()
+        self.assertEqual(len([
+            query for query in queries
+            if query['sql'].split()[:2] in (['UPDATE', 'core_thread'],
+                                            ['UPDATE', '"core_thread"'])
+        ]), 1)
+        thread.refresh_from_db()
+        self.assertEqual((thread.seq, thread.last_message),
+                         (message.seq, message.date))
+
+    def test_models_message_write_behind_persist(self):
+        thread = Thread.objects.create(name='Test thread')
+        date = timezone.now() - datetime.timedelta(seconds=10)
+        entry = {'nonce': uuid.uuid4().hex, 'thread': thread.pk,
+                 'user': self.user_bob.pk, 'text': 'Hello', 'lang': 'en',
+                 'date': date.isoformat()}
+        ids = ingest.persist([entry])
+        message = Message.objects.get(thread=thread)
+        self.assertEqual(ids, {thread.pk: {
+            entry['nonce']: {'pk': message.pk, 'seq': 1}
+        }})
+        # The broadcast date, not the flush time.
+        self.assertEqual(message.date, date)
+        thread.refresh_from_db()
+        self.assertEqual(thread.last_message, date)
+
+        # Replayed entries are not inserted again.
+        self.assertEqual(ingest.persist([entry]), ids)
+        self.assertEqual(Message.objects.filter(thread=thread).count(), 1)
+
+    def test_models_message_write_behind_recover(self):
+        thread = Thread.objects.create(name='Test thread')
+        conn = ingest._redis()
+        # A journal of a dead process: its lock has expired.
+        journal = ingest._key('message_journal:test')
+        conn.rpush(journal, *(json.dumps({
+            'nonce': uuid.uuid4().hex, 'thread': thread.pk,
+            'user': self.user_bob.pk, 'text': text, 'lang': 'en',
+            'date': timezone.now().isoformat()
+        }) for text in ('Hello', 'Bye')))
+        conn.sadd(ingest._key(ingest.JOURNALS_KEY), journal)
+        # A journal of a live process.
+        alive = ingest._key('message_journal:test_alive')
+        conn.rpush(alive, json.dumps({
+            'nonce': uuid.uuid4().hex, 'thread': thread.pk,
+            'user': self.user_bob.pk, 'text': 'Alive', 'lang': 'en',
+            'date': timezone.now().isoformat()
+        }))
+        conn.set(ingest._lock_key(alive), alive)
+        conn.sadd(ingest._key(ingest.JOURNALS_KEY), alive)
+        try:
+            self.assertEqual(ingest.recover(), 2)
+            self.assertEqual(
+                sorted(Message.objects.filter(
+                    thread=thread
+                ).values_list('text', flat=True)),
+                ['Bye', 'Hello']
+            )
+            self.assertFalse(conn.exists(journal))
+            self.assertTrue(conn.exists(alive))
+        finally:
+            conn.srem(ingest._key(ingest.JOURNALS_KEY), journal, alive)
+            conn.delete(journal, alive, ingest._lock_key(alive))
+
+    def test_models_message_write_behind_stalled(self):
+        conn = ingest._redis()
+        journals = ingest._key(ingest.JOURNALS_KEY)
+        # A buffer without the flusher thread.
+        buffer = ingest.MessageBuffer.__new__(ingest.MessageBuffer)
+        buffer.journal = ingest._key('message_journal:test_stalled')
+        self.addCleanup(conn.srem, journals, buffer.journal)
+        self.addCleanup(conn.delete, ingest._lock_key(buffer.journal))
+        buffer.refresh_lock()
+        self.assertTrue(conn.sismember(journals, buffer.journal))
+
+        # The process stalled longer than the lock timeout and the journal
+        # was recovered, the next refresh registers it again.
+        conn.delete(ingest._lock_key(buffer.journal))
+        ingest.recover()
+        self.assertFalse(conn.sismember(journals, buffer.journal))
+        buffer.refresh_lock()
+        self.assertTrue(conn.sismember(journals, buffer.journal))
+
+    def test_models_message_recent(self):
+        thread = Thread.objects.create(name='Test thread')
+        self.addCleanup(recent.invalidate, thread.pk)
+        for text in ('Hello', 'Hi'):
+            Message(thread=thread, user=self.user_bob, text=text).save()
+
+        # A miss, fill the cache from the database.
+        messages, complete, version = recent.get(thread.pk)
+        self.assertIsNone(messages)
+        messages = list(Message.objects.filter(thread=thread)
+                        .order_by('-seq'))
+        recent.fill(thread.pk, messages, version)
+        cached, complete, _ = recent.get(thread.pk)
+        self.assertEqual([(message.pk, message.text, message.date)
+                          for message in cached],
+                         [(message.pk, message.text, message.date)
+                          for message in messages])
+        self.assertTrue(complete)
+
+        # New messages are pushed (on commit), a message the fill
+        # already has is not duplicated.
+        message = Message(thread=thread, user=self.user_bob, text='Bye')
+        message.save()
+        recent.push([message])
+        recent.push([message])
+        cached, complete, version = recent.get(thread.pk)
+        self.assertEqual([message.text for message in cached],
+                         ['Bye', 'Hi', 'Hello'])
+        self.assertTrue(complete)
+
+        # A full list is not the whole thread anymore.
+        with self.settings(THREAD_RECENT_MESSAGES=3):
+            message = Message(thread=thread, user=self.user_bob, text='Hey')
+            message.save()
+            recent.push([message])
+            cached, complete, version = recent.get(thread.pk)
+        self.assertEqual([message.text for message in cached],
+                         ['Hey', 'Bye', 'Hi'])
+        self.assertFalse(complete)
+
+        # Edits drop the cache, an older fill doesn't bring it back.
+        recent.invalidate(thread.pk)
+        recent.fill(thread.pk, messages, version)
+        self.assertEqual(recent.get(thread.pk), (None, False, mock.ANY))
+
+        # Deleting the newest message doesn't make later reads miss.
+        message.delete()
+        messages, complete, version = recent.get(thread.pk)
+        recent.fill(thread.pk, list(Message.objects.filter(thread=thread)
+                                    .order_by('-seq')), version)
+        cached, complete, _ = recent.get(thread.pk)
+        self.assertEqual([message.text for message in cached],
+                         ['Bye', 'Hi', 'Hello'])
+
+    def test_models_thread_pair(self):
+        thread = Thread.get_or_create_pair(self.user_bob, self.user_steve)
+        self.assertEqual(set(thread.users.all()),
+                         {self.user_bob, self.user_steve})
+        # The same thread for any order of users.
+        self.assertEqual(
+            Thread.get_or_create_pair(self.user_steve, self.user_bob), thread
+        )
+
+        # A third user makes it a group thread.
+        thread.users.add(
+            User.objects.create_user(username='test_model_user3')
+        )
+        thread.refresh_from_db()
+        self.assertIsNone(thread.pair_key)
+        self.assertNotEqual(
+            Thread.get_or_create_pair(self.user_bob, self.user_steve), thread
+        )
@@ -1,17 +1,20 @@
-from unittest import mock
+from unittest import mock, skipUnless
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from .models import Thread
+from . import recent, tiles
+from .models import Message, Profile, Thread, UnreadThread
 
 
 class ChatViewTest(TestCase):
     def setUp(self):
         # No need to set cache seen for tests users for testing views.
-        view_patcher_cache = mock.patch('core.middleware.cache')
+        view_patcher_cache = mock.patch('core.middleware.presence')
         self.mock_cache = view_patcher_cache.start()
         self.addCleanup(view_patcher_cache.stop)
         # Create usual user.
@@ -71,6 +74,65 @@ class ChatViewTest(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertTemplateUsed(resp, 'user_list.html')
 
+    @mock.patch.object(settings, 'USER_LIST_PAGE_SIZE', 2)
+    def test_views_user_list_pages(self):
+        for i in range(3):
+            User.objects.create_user(username='page_user{}'.format(i))
+        self.client.login(username='testuser', password='12345')
+
+        def page(**params):
+            resp = self.client.get(reverse('core:user_list'), params)
+            return ([user.username for user in resp.context['users']],
+                    resp.context['previous'], resp.context['next'])
+
+        # The chatbot user is created by a migration.
+        self.assertEqual(page(),
+                         (['chatbot', 'page_user0'], None, 'page_user0'))
+        self.assertEqual(page(after='page_user0'),
+                         (['page_user1', 'page_user2'], 'page_user1',
+                          'page_user2'))
+        # The current user is not listed.
+        self.assertEqual(page(after='page_user2'),
+                         (['testadmin', 'testuser2'], 'testadmin', None))
+        self.assertEqual(page(before='page_user1'),
+                         (['chatbot', 'page_user0'], None, 'page_user0'))
+
+    def test_views_user_search(self):
+        User.objects.create_user(username='Alice')
+        User.objects.create_user(username='malice')
+        url = reverse('core:user_search')
+        resp = self.client.get(url, {'q': 'al'})
+        self.assertRedirects(resp, '/login?next=/users/search%3Fq%3Dal')
+
+        self.client.login(username='testuser', password='12345')
+
+        def search(q):
+            resp = self.client.get(url, {'q': q})
+            self.assertEqual(resp.status_code, 200)
+            return [user['username'] for user in resp.json()['users']]
+
+        self.assertEqual(search(''), [])
+        # Short queries match the prefix, longer ones any part.
+        self.assertEqual(search('al'), ['Alice'])
+        self.assertEqual(search('ALI'), ['Alice', 'malice'])
+        self.assertEqual(search('testuser'), ['testuser2'])
+
+        with mock.patch.object(settings, 'USER_SEARCH_LIMIT', 1):
+            self.assertEqual(search('ali'), ['Alice'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL indexes')
+    def test_user_search_indexes(self):
+        with connection.cursor() as cursor:
+            # Tiny test tables are scanned sequentially otherwise.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = User.objects.filter(username__icontains='user').explain()
+        self.assertIn('core_user_username_trgm', plan)
+        plan = User.objects.filter(username__istartswith='te').explain()
+        self.assertIn('core_user_username_upper', plan)
+        plan = User.objects.filter(username__gt='testuser')\
+            .order_by('username')[:50].explain()
+        self.assertIn('auth_user_username', plan)
+
     def test_views_chatbot(self):
         resp = self.client.get('/chat/chatbot')
         self.assertRedirects(resp, '/login?next=/chat/chatbot')
@@ -211,6 +273,159 @@ class ChatViewTest(TestCase):
                                        kwargs={'thread_id': '404'}))
         self.assertEqual(resp.status_code, 404)
 
+        # Only members can open the thread, staff read it (admin links)
+        # without joining.
+        User.objects.create_user(username='testuser3', password='12345')
+        self.client.login(username='testuser3', password='12345')
+        resp = self.client.get(reverse('core:thread',
+                                       kwargs={'thread_id': chat[0].pk}))
+        self.assertEqual(resp.status_code, 404)
+        self.client.login(username='testadmin', password='12345')
+        with mock.patch.object(UnreadThread, 'mark_read') as mark_read:
+            resp = self.client.get(reverse('core:thread',
+                                           kwargs={'thread_id': chat[0].pk}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.context['read_only'])
+        self.assertNotContains(resp, 'btn-chat"')
+        mark_read.assert_not_called()
+
+    def test_views_thread_messages(self):
+        user = User.objects.get(username='testuser')
+        thread = Thread.objects.create(name='Test thread')
+        thread.users.add(user)
+        for i in range(5):
+            Message(thread=thread, user=user, text=str(i)).save()
+        # Cursors are unique with equal dates too.
+        Message.objects.filter(text__in=['1', '2', '3']).update(
+            date=Message.objects.get(text='1').date
+        )
+        url = reverse('core:thread_messages', kwargs={'thread_id': thread.pk})
+
+        # Only thread members can read messages.
+        self.client.login(username='testuser2', password='12345')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.login(username='testadmin', password='12345')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.client.login(username='testuser', password='12345')
+        self.assertEqual(
+            self.client.get(url, {'before': 'bad'}).status_code, 400
+        )
+
+        # Page back from the newest messages.
+        texts = []
+        params = {'limit': 2}
+        while True:
+            page = self.client.get(url, params).json()
+            texts = [message['fields']['text']
+                     for message in page['messages']] + texts
+            if not page['before']:
+                break
+            params['before'] = page['before']
+        self.assertEqual(texts, ['0', '1', '2', '3', '4'])
+
+        # Page forward from the oldest page.
+        page = self.client.get(url, {'after': page['after'],
+                                     'limit': 10}).json()
+        self.assertEqual([message['fields']['text']
+                          for message in page['messages']],
+                         ['1', '2', '3', '4'])
+        self.assertIsNone(page['after'])
+
+    def test_views_thread_recent_messages(self):
+        user = User.objects.get(username='testuser')
+        thread = Thread.objects.create(name='Test thread')
+        self.addCleanup(recent.invalidate, thread.pk)
+        thread.users.add(user)
+        Message(thread=thread, user=user, text='Hello').save()
+        url = reverse('core:thread', kwargs={'thread_id': thread.pk})
+        self.client.login(username='testuser', password='12345')
+
+        self.assertContains(self.client.get(url), 'Hello')
+        # The second time messages come from the cache.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(url), 'Hello')
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'FROM "core_message"' in query['sql']
+        ])
+
+    def test_views_thread_recent_messages_history(self):
+        user = User.objects.get(username='testuser')
+        thread = Thread.objects.create(name='Test thread')
+        self.addCleanup(recent.invalidate, thread.pk)
+        thread.users.add(user)
+        for text in ('Hello', 'Hi', 'Bye'):
+            message = Message(thread=thread, user=user, text=text)
+            message.save()
+        url = reverse('core:thread', kwargs={'thread_id': thread.pk})
+        self.client.login(username='testuser', password='12345')
+
+        with self.settings(THREAD_RECENT_MESSAGES=2):
+            self.assertNotEqual(self.client.get(url).context['history_cursor'],
+                                '')
+            # A late push of a message the fill already has.
+            recent.push([message])
+            self.assertNotEqual(self.client.get(url).context['history_cursor'],
+                                '')
+            page = self.client.get(
+                reverse('core:thread_messages',
+                        kwargs={'thread_id': thread.pk}),
+                {'limit': 2}
+            ).json()
+        self.assertIsNotNone(page['before'])
+
+    def test_views_thread_recent_messages_deleted(self):
+        user = User.objects.get(username='testuser')
+        author = User.objects.create_user(username='author')
+        thread = Thread.objects.create(name='Test thread')
+        self.addCleanup(recent.invalidate, thread.pk)
+        thread.users.add(user, author)
+        Message(thread=thread, user=user, text='Hello').save()
+        Message(thread=thread, user=author, text='Bye').save()
+        url = reverse('core:thread', kwargs={'thread_id': thread.pk})
+        self.client.login(username='testuser', password='12345')
+        self.assertContains(self.client.get(url), 'Bye')
+
+        # Cached messages of a deleted author are skipped before
+        # the commit drops them.
+        author.delete()
+        resp = self.client.get(url)
+        self.assertContains(resp, 'Hello')
+        self.assertNotContains(resp, 'Bye')
+
+        # Queryset deletes drop cached messages too.
+        with mock.patch('django.db.transaction.on_commit',
+                        lambda func, using=None: func()):
+            Message.objects.filter(thread=thread, text='Hello').delete()
+        self.assertNotContains(self.client.get(url), 'Hello')
+
+    def thread_page_queries(self, members):
+        """ Return a number of queries of the thread page. """
+        user = User.objects.get(username='testuser')
+        thread = Thread.objects.create(name='Test thread')
+        self.addCleanup(recent.invalidate, thread.pk)
+        thread.users.add(user, *(
+            User.objects.create_user(
+                username='testuser_{}_{}'.format(members, i)
+            )
+            for i in range(members - 1)
+        ))
+        for member in thread.users.all():
+            Message(thread=thread, user=member, text='Hello').save()
+
+        self.client.login(username='testuser', password='12345')
+        url = reverse('core:thread', kwargs={'thread_id': thread.pk})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        return len(queries)
+
+    def test_views_thread_queries(self):
+        # Members profiles are resolved (and created) in bulk.
+        self.assertEqual(self.thread_page_queries(2),
+                         self.thread_page_queries(10))
+
     def test_views_call(self):
         resp = self.client.get(reverse('core:call',
                                        kwargs={'username': 'testuser2'}))
@@ -235,3 +450,62 @@ class ChatViewTest(TestCase):
         resp = self.client.get(reverse('core:users_map'))
         self.assertEqual(resp.status_code, 200)
         self.assertTemplateUsed(resp, 'users_map.html')
+
+    def test_users_map_tiles(self):
+        locations = {'testuser': (51.5, -0.12), 'testuser2': (51.51, -0.13),
+                     'testadmin': (40.71, -74.0)}
+        for username, (lat, lon) in locations.items():
+            tiles.invalidate(tiles.geo_key(lat, lon))
+            self.addCleanup(tiles.invalidate, tiles.geo_key(lat, lon))
+            Profile.objects.create(user=User.objects.get(username=username),
+                                   lat=lat, lon=lon)
+        url = reverse('core:users_map_tiles')
+        self.client.login(username='testadmin', password='12345')
+
+        resp = self.client.get(url, {'bbox': '-180,-85,180,85', 'zoom': 0})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['users'], [])
+        counts = sorted(cluster['count']
+                        for cluster in resp.json()['clusters'])
+        self.assertEqual(counts, [1, 2])
+
+        # Tiles are cached.
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url, {'bbox': '-180,-85,180,85',
+                                         'zoom': 0})
+        self.assertEqual(sorted(cluster['count']
+                                for cluster in resp.json()['clusters']),
+                         [1, 2])
+        self.assertFalse([query for query in queries
+                          if 'core_profile' in query['sql']])
+
+        # Users at high zooms.
+        resp = self.client.get(url, {'bbox': '-0.2,51.45,-0.05,51.55',
+                                     'zoom': settings.USERS_MAP_POINTS_ZOOM})
+        self.assertEqual(resp.json()['clusters'], [])
+        self.assertEqual(sorted(user['username']
+                                for user in resp.json()['users']),
+                         ['testuser', 'testuser2'])
+
+        # Big maps get fewer, lower zoom tiles.
+        with mock.patch.object(tiles, 'build',
+                               wraps=tiles.build) as build:
+            resp = self.client.get(url, {'bbox': '-180,-85,180,85',
+                                         'zoom': 9})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(cluster['count']
+                                for cluster in resp.json()['clusters']),
+                         [1, 2])
+        built = [call[0][0] for call in build.call_args_list]
+        self.assertTrue(built)
+        self.assertLessEqual(len(built), settings.USERS_MAP_MAX_TILES)
+        self.assertEqual(len(built[0]), 3)
+        # Users on a big map at a high zoom.
+        resp = self.client.get(url, {'bbox': '-10,40,10,60',
+                                     'zoom': settings.USERS_MAP_POINTS_ZOOM})
+        self.assertEqual(sorted(user['username']
+                                for user in resp.json()['users']),
+                         ['testuser', 'testuser2'])
+
+        resp = self.client.get(url, {'bbox': 'a,b', 'zoom': 1})
+        self.assertEqual(resp.status_code, 400)
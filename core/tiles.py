@@ -0,0 +1,165 @@
+"""
+Users map tiles.
+
+Every profile with a location has a geo key - the quadkey of the web
+mercator tile at GEO_KEY_ZOOM with the location. Quadkeys of the tiles
+with the location at lower zooms are prefixes of the geo key, so users of
+a tile are a prefix range of the geo key index and a grid of clusters of
+a tile is a GROUP BY of a longer prefix.
+
+Below USERS_MAP_POINTS_ZOOM a tile is a grid of 2 ** USERS_MAP_GRID_BITS
+by 2 ** USERS_MAP_GRID_BITS cells with user counts and centroids, at
+higher map zooms it lists users. Big maps get fewer, lower zoom tiles.
+Tiles are cached, a location change drops the tiles of the old and the
+new location.
+"""
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Count
+from django.db.models.functions import Substr
+from django.urls import reverse
+
+GEO_KEY_ZOOM = 16
+# Web mercator has no poles.
+MAX_LAT = 85.05112878
+TILE_KEY = 'users_map_tile:{}'
+
+
+def tile_xy(lat, lon, zoom):
+    """ Return (x, y) of the tile at the zoom with the location. """
+    n = 2 ** zoom
+    lat = math.radians(min(max(lat, -MAX_LAT), MAX_LAT))
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def quadkey(x, y, zoom):
+    """ Return the quadkey of the tile. """
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+def geo_key(lat, lon):
+    """ Return the geo key of the location or None. """
+    if lat is None or lon is None:
+        return None
+
+    return quadkey(*tile_xy(lat, lon, GEO_KEY_ZOOM), GEO_KEY_ZOOM)
+
+
+def set_geo_key(profile, save_kwargs):
+    """
+    Set the geo key of the profile location before a save, add it to
+    update_fields of the save if the location is there, return the old
+    geo key.
+    """
+    old_geo_key = profile.geo_key
+    profile.geo_key = geo_key(profile.lat, profile.lon)
+    update_fields = save_kwargs.get('update_fields')
+    if update_fields is not None and {'lat', 'lon'} & set(update_fields):
+        save_kwargs['update_fields'] = set(update_fields) | {'geo_key'}
+    return old_geo_key
+
+
+def bbox_quadkeys(west, south, east, north, zoom):
+    """
+    Return quadkeys of tiles covering the bounding box at the zoom, or at
+    the highest lower zoom with at most USERS_MAP_MAX_TILES of them.
+    """
+    for zoom in range(zoom, -1, -1):
+        n = 2 ** zoom
+        min_x, min_y = tile_xy(north, west, zoom)
+        max_x, max_y = tile_xy(south, east, zoom)
+        if west > east:
+            # The box crosses the antimeridian.
+            xs = list(range(min_x, n)) + list(range(0, max_x + 1))
+        else:
+            xs = range(min_x, max_x + 1)
+        ys = range(min_y, max_y + 1)
+
+        if len(xs) * len(ys) <= settings.USERS_MAP_MAX_TILES:
+            break
+
+    return [quadkey(x, y, zoom) for x in xs for y in ys]
+
+
+def _cache_key(key, points):
+    return TILE_KEY.format(key + (':points' if points else ''))
+
+
+def build(key, points):
+    """ Return users or clusters of the tile from the database. """
+    from .models import Profile
+
+    profiles = Profile.objects.filter(geo_key__startswith=key)
+    zoom = len(key)
+    if points:
+        return {'clusters': [], 'users': [
+            {
+                'username': profile.user__username,
+                'location': {'lat': profile.lat, 'lng': profile.lon},
+                'profile': reverse('core:user',
+                                   kwargs={'username': profile.user__username})
+            }
+            for profile in profiles.values_list(
+                'user__username', 'lat', 'lon', named=True
+            )
+        ]}
+
+    cells = profiles.annotate(
+        cell=Substr('geo_key', 1, zoom + settings.USERS_MAP_GRID_BITS)
+    ).values('cell').annotate(
+        count=Count('pk'), lat=Avg('lat'), lon=Avg('lon')
+    ).order_by()
+    return {'clusters': [
+        {
+            'location': {'lat': cell['lat'], 'lng': cell['lon']},
+            'count': cell['count'],
+        }
+        for cell in cells
+    ], 'users': []}
+
+
+def get(keys, points=False):
+    """
+    Return users (if points) or clusters of the tiles, build missing
+    tiles.
+    """
+    cached = cache.get_many([_cache_key(key, points) for key in keys])
+    missing = {}
+    result = {'clusters': [], 'users': []}
+    for key in keys:
+        tile = cached.get(_cache_key(key, points))
+        if tile is None:
+            tile = missing[_cache_key(key, points)] = build(key, points)
+        result['clusters'].extend(tile['clusters'])
+        result['users'].extend(tile['users'])
+
+    if missing:
+        cache.set_many(missing, settings.USERS_MAP_TILE_TIMEOUT)
+
+    return result
+
+
+def invalidate(*geo_keys):
+    """ Drop cached tiles with the geo keys. """
+    keys = list({
+        _cache_key(key[:zoom], points)
+        for key in geo_keys if key
+        for zoom in range(settings.USERS_MAP_POINTS_ZOOM + 1)
+        for points in (False, True)
+    })
+    if not keys:
+        return
+
+    cache.delete_many(keys)
+    if transaction.get_connection().in_atomic_block:
+        # A request could cache the old tiles before the commit.
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,98 @@
+"""
+Unread threads menu and notifications.
+
+The menu (the last unread threads, or the last active threads if there
+are none) is cached per user and dropped on changes. Users get 'unread'
+and 'read' notifications in a per-user group. When a user read a thread
+is remembered for a while, so a deferred mark_unread skips users who
+already read the message.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+MENU_KEY = 'unread_threads_menu:{}'
+READ_KEY = 'thread_read:{}:{}'
+
+
+def remember_read(thread_id, user_id):
+    """ Remember that the user read the thread now. """
+    cache.set(READ_KEY.format(thread_id, user_id), timezone.now(),
+              settings.UNREAD_THREADS_READ_TIMEOUT)
+
+
+def not_read_since(thread_id, user_ids, date):
+    """ Return ids of users who didn't read the thread since the date. """
+    keys = {user_id: READ_KEY.format(thread_id, user_id)
+            for user_id in user_ids}
+    read = cache.get_many(list(keys.values()))
+    return [
+        user_id for user_id, key in keys.items()
+        if key not in read or read[key] < date
+    ]
+
+
+def notifications_group(user_id):
+    """ Return a group name to send the user notifications to. """
+    return 'notifications-{}'.format(user_id)
+
+
+def send_notifications(thread_id, user_ids, action):
+    """ Tell users that the thread became unread or read. """
+    channel_layer = get_channel_layer()
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(
+            notifications_group(user_id),
+            {
+                'type': 'notifications.update',
+                'action': action,
+                'thread': thread_id,
+            }
+        )
+
+
+def get_menu(user_id):
+    """
+    Return unread threads of the user (the last active threads
+    if there are none) and a number of unread threads, cached.
+    """
+    from .models import Thread, UnreadThread
+
+    menu = cache.get(MENU_KEY.format(user_id))
+    if menu is not None:
+        return menu
+
+    threads = list(
+        UnreadThread.objects.filter(user_id=user_id)
+        .order_by('-date')
+        .values('thread__id', 'thread__name')[:10]
+    )
+    threads = [{'id': thread['thread__id'], 'name': thread['thread__name']}
+               for thread in threads]
+    menu = {'threads': threads, 'unread_threads': len(threads)}
+    # If there no unread threads - show last threads.
+    if not threads:
+        menu['threads'] = list(
+            Thread.objects.filter(
+                users=user_id, last_message__isnull=False
+            ).order_by('-last_message').values('id', 'name')[:10]
+        )
+
+    cache.set(MENU_KEY.format(user_id), menu,
+              settings.UNREAD_THREADS_CACHE_TIMEOUT)
+    return menu
+
+
+def invalidate_menu(user_ids):
+    """ Drop cached unread threads of the users. """
+    keys = [MENU_KEY.format(user_id) for user_id in user_ids]
+    if not keys:
+        return
+
+    cache.delete_many(keys)
+    if transaction.get_connection().in_atomic_block:
+        # A request could cache the old state before the commit.
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -4,7 +4,8 @@ from django.urls import path
 from django.utils.translation import ugettext_lazy as _
 
 from .views import (about_page, log_in, log_out, sign_up, user_list, user_map,
-                    ThreadView, call_view, ProfileView)
+                    ThreadView, call_view, ProfileView, thread_messages,
+                    user_search, user_map_tiles)
 
 
 app_name = "Chat"
@@ -16,9 +17,13 @@ urlpatterns = [
     path('signup', sign_up, name='signup'),
     path('', user_list, name='user_list'),
     path('users', user_map, name='users_map'),
+    path('users/search', user_search, name='user_search'),
+    path('users/tiles', user_map_tiles, name='users_map_tiles'),
     path('user/<str:username>', ProfileView.as_view(), name='user'),
     path('chat/<str:username>', ThreadView.as_view(), name='chat'),
     path('thread/<int:thread_id>', ThreadView.as_view(), name='thread'),
+    path('thread/<int:thread_id>/messages', thread_messages,
+         name='thread_messages'),
     path('call/<str:username>', call_view, name='call'),
 ]
 admin.site.site_header = _('Chat administration')
@@ -1,4 +1,4 @@
-import json
+import datetime
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
@@ -7,15 +7,18 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.core.exceptions import ValidationError, PermissionDenied
-from django.db.models import Count
+from django.db.models import Q
 from django.http import JsonResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import ugettext
 from django.views import View
 
+from . import recent, tiles, unread
 from .models import Profile, Thread, UnreadThread, Message
 from .forms import AvatarForm
+from .payloads import message_data
 
 User = get_user_model()
 
@@ -39,40 +42,96 @@ class GetUserMixin:
 
 @login_required
 def user_list(request):
-    """ User list. """
-    users = User.objects.exclude(id=request.user.id)\
-        .values_list('username', 'last_login', named=True).order_by('username')
-
-    return render(request, 'user_list.html', {'users': users})
+    """ User list, a page after or before the given username. """
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    size = settings.USER_LIST_PAGE_SIZE
 
+    # Seek by username instead of OFFSET, pages cost the same.
+    users = User.objects.exclude(id=request.user.id)\
+        .values_list('username', 'last_login', named=True)
+    if before:
+        users = list(users.filter(username__lt=before)
+                     .order_by('-username')[:size + 1])
+        has_more = len(users) > size
+        users = users[:size][::-1]
+        has_previous, has_next = has_more, True
+    else:
+        if after:
+            users = users.filter(username__gt=after)
+        users = list(users.order_by('username')[:size + 1])
+        has_more = len(users) > size
+        users = users[:size]
+        has_previous, has_next = bool(after), has_more
+
+    return render(request, 'user_list.html', {
+        'users': users,
+        'previous': users[0].username if users and has_previous else None,
+        'next': users[-1].username if users and has_next else None,
+    })
 
-@staff_member_required
-def user_map(request):
-    """ Maps with users. """
-    users = Profile.objects.select_related('user').filter(
-        lat__isnull=False, lon__isnull=False
-    ).values_list('user__username', 'lat', 'lon', named=True)
 
-    users = [
+@login_required
+def user_search(request):
+    """ Users with the username starting with or containing 'q'. """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'users': []})
+
+    users = User.objects.exclude(id=request.user.id)
+    if len(query) < 3:
+        # Too short for trigrams - match the prefix.
+        users = users.filter(username__istartswith=query)
+    else:
+        users = users.filter(username__icontains=query)
+    users = users.order_by('username').values_list(
+        'username', 'last_login', named=True
+    )[:settings.USER_SEARCH_LIMIT]
+
+    return JsonResponse({'users': [
         {
-            'username': user.user__username,
-            'location': {
-                'lat': user.lat,
-                'lng': user.lon,
-            },
+            'username': user.username,
+            'last_login': user.last_login,
+            'chat': reverse('core:chat', kwargs={'username': user.username}),
             'profile': reverse('core:user',
-                               kwargs={'username': user.user__username})
+                               kwargs={'username': user.username}),
         }
         for user in users
-    ]
-    users = json.dumps(users)
+    ]})
+
 
+@staff_member_required
+def user_map(request):
+    """ Maps with users. """
     return render(request, 'users_map.html', {
-        'users': users,
         'google_map_api_key': settings.GOOGLE_MAP_API_KEY
     })
 
 
+@staff_member_required
+def user_map_tiles(request):
+    """
+    User clusters, or users at high zooms, in the bounding box
+    'west,south,east,north' at the zoom.
+    """
+    try:
+        west, south, east, north = map(
+            float, request.GET.get('bbox', '').split(',')
+        )
+        zoom = min(int(request.GET.get('zoom', '')),
+                   settings.USERS_MAP_POINTS_ZOOM)
+        if zoom < 0:
+            raise ValueError('Negative zoom')
+        keys = tiles.bbox_quadkeys(west, south, east, north, zoom)
+    except ValueError:
+        return JsonResponse(ugettext('Invalid bounding box or zoom'),
+                            safe=False, status=400)
+
+    return JsonResponse(
+        tiles.get(keys, points=zoom >= settings.USERS_MAP_POINTS_ZOOM)
+    )
+
+
 def about_page(request):
     """ About page. """
     return render(request, 'about.html')
@@ -146,65 +205,70 @@ class ThreadView(View, GetUserMixin):
             return redirect_to_login(request.path)
 
         interlocutor = None
+        read_only = False
         if username:
             interlocutor = get_object_or_404(User, username=username)
-            thread = Thread.objects\
-                .annotate(count=Count('users'))\
-                .filter(users=request.user)\
-                .filter(users=interlocutor)\
-                .filter(count=2)\
-                .first()
-            if not thread:
-                thread = Thread(name=', '.join(
-                    [request.user.username, username]
-                ))
-                thread.save()
-                thread.users.add(request.user, interlocutor)
+            thread = Thread.get_or_create_pair(request.user, interlocutor)
         elif thread_id:
             thread = get_object_or_404(Thread, pk=thread_id)
+            if not thread.users.filter(pk=request.user.pk).exists():
+                # Staff read any thread (admin links) without the
+                # websocket, others only own threads, as for the websocket.
+                if not request.user.is_staff:
+                    raise Http404
+                read_only = True
         else:
             # username or thread_id should be passed.
             raise Http404
 
-        # The user visited this tread - delete user's unread thread.
-        UnreadThread.objects.filter(thread=thread, user=request.user).delete()
+        if not read_only:
+            # The user visited this tread - delete user's unread thread.
+            UnreadThread.mark_read(thread.pk, request.user.pk)
 
-        # Prepare usernames and user avatars.
-        users = {}
-        for user in thread.users.all():
-            profile, _ = Profile.objects.get_or_create(user=user)
-            users[user.pk] = {
+        # Get last messages, from the recent messages cache if possible.
+        messages, complete, version = recent.get(thread.pk)
+        if messages is None:
+            messages = list(
+                Message.objects.filter(thread=thread).order_by('-seq')
+                [:settings.THREAD_RECENT_MESSAGES]
+            )
+            complete = len(messages) < settings.THREAD_RECENT_MESSAGES
+            recent.fill(thread.pk, messages, version)
+
+        # Prepare usernames and user avatars of members and authors
+        # (they could leave the thread) in one query.
+        thread_users = list(User.objects.select_related('profile').filter(
+            Q(threads=thread) |
+            Q(pk__in={message.user_id for message in messages})
+        ).distinct())
+        profiles = Profile.get_or_create_many(thread_users)
+        users = {
+            user.pk: {
                 'username': user.username,
-                'avatar': profile.avatar.url,
+                'avatar': profiles[user.pk].avatar.url,
             }
-
-        # Get last 50 messages.
-        messages = Message.objects.select_related('user', 'user__profile') \
-                          .filter(thread=thread).order_by('-date')[:50]
-        for message in messages:
-            if message.user_id not in users:
-                try:
-                    avatar = message.user.profile.avatar.url
-                except Profile.DoesNotExist:
-                    # If there no user profile - create it.
-                    profile, _ = Profile.objects.get_or_create(
-                        user=message.user
-                    )
-                    avatar = profile.avatar.url
-
-                users[message.user_id] = {
-                    'username': message.user.username,
-                    'avatar': avatar,
-                }
-        # Now we have all needed info - update messages.
+            for user in thread_users
+        }
+        # Now we have all needed info - update messages. Skip cached
+        # messages of a just deleted author, they are gone on commit.
+        shown = []
         for message in messages:
-            message.avatar = users[message.user_id]['avatar']
+            if message.user_id in users:
+                message.username = users[message.user_id]['username']
+                message.avatar = users[message.user_id]['avatar']
+                shown.append(message)
 
         return render(request, 'thread.html', {
             'thread': thread,
-            'messages': reversed(messages),
+            'messages': reversed(shown),
+            # The client resumes from it after a reconnect.
+            'last_seq': messages[0].seq if messages else 0,
+            # The client loads older messages from it.
+            'history_cursor': history_cursor(messages[-1])
+            if messages and not complete else '',
             'users': users,
             'interlocutor': interlocutor,
+            'read_only': read_only,
         })
 
     # noinspection PyMethodMayBeStatic
@@ -215,12 +279,17 @@ class ThreadView(View, GetUserMixin):
         value = request.POST.get('value', '')
         if field and field in allowed_fields:
             thread = get_object_or_404(Thread, pk=thread_id)
-            if request.user in thread.users.all():
+            members = list(thread.users.all())
+            if request.user in members:
                 # User has permission to edit thread.
                 setattr(thread, field, value)
                 try:
                     thread.clean_fields()
                     thread.save()
+                    # Thread names are shown in the unread threads menu.
+                    unread.invalidate_menu(
+                        [member.pk for member in members]
+                    )
                     return JsonResponse({'success': True})
                 except ValidationError as e:
                     return JsonResponse(
@@ -236,6 +305,95 @@ class ThreadView(View, GetUserMixin):
         )
 
 
+def history_cursor(message):
+    """ Return a history cursor pointing at the message. """
+    delta = message.date - timezone.make_aware(datetime.datetime(1970, 1, 1),
+                                               timezone.utc)
+    # Exact microseconds, a float timestamp loses precision.
+    return '{}_{}'.format(delta // datetime.timedelta(microseconds=1),
+                          message.pk)
+
+
+def parse_history_cursor(cursor):
+    """ Return (date, id) of a history cursor, raise ValueError if bad. """
+    microseconds, pk = (int(part) for part in cursor.split('_'))
+    date = timezone.make_aware(datetime.datetime(1970, 1, 1), timezone.utc) \
+        + datetime.timedelta(microseconds=microseconds)
+
+    return date, pk
+
+
+@login_required
+def thread_messages(request, thread_id):
+    """
+    A page of thread messages older than 'before' or newer than 'after'
+    cursor, the newest messages without a cursor.
+    """
+    threads = Thread.objects.filter(pk=thread_id)
+    if not request.user.is_staff:
+        # Staff read any thread, others only own threads.
+        threads = threads.filter(users=request.user)
+    if not threads.exists():
+        raise Http404
+
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    try:
+        limit = min(int(request.GET.get('limit',
+                                        settings.MESSAGE_HISTORY_PAGE_SIZE)),
+                    settings.MESSAGE_HISTORY_MAX_PAGE_SIZE)
+        date, pk = parse_history_cursor(after or before) \
+            if after or before else (None, None)
+    except ValueError:
+        return JsonResponse(ugettext('Invalid cursor'), safe=False,
+                            status=400)
+    if limit < 1:
+        return JsonResponse(ugettext('Invalid limit'), safe=False,
+                            status=400)
+
+    messages = None
+    if not after:
+        # Try the recent messages cache first.
+        cached, complete, _ = recent.get(thread_id)
+        if cached is not None:
+            page = sorted((
+                message for message in cached
+                if not before or (message.date, message.pk) < (date, pk)
+            ), key=lambda message: (message.date, message.pk), reverse=True)
+            if len(page) > limit or complete:
+                messages = page[:limit + 1]
+
+    if messages is None:
+        # Seek by (date, id) instead of OFFSET, so deep pages are as cheap
+        # as the first one. Redundant date__lte/gte bounds the index scan.
+        messages = Message.objects.filter(thread_id=thread_id)
+        if after:
+            messages = messages.filter(date__gte=date).filter(
+                Q(date__gt=date) | Q(date=date, pk__gt=pk)
+            ).order_by('date', 'pk')
+        else:
+            if before:
+                messages = messages.filter(date__lte=date).filter(
+                    Q(date__lt=date) | Q(date=date, pk__lt=pk)
+                )
+            messages = messages.order_by('-date', '-pk')
+        messages = list(messages[:limit + 1])
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
+
+    return JsonResponse({
+        'messages': [message_data(message) for message in messages],
+        # Cursors of older and newer pages if there are any.
+        'before': history_cursor(messages[0])
+        if messages and (has_more or after) else None,
+        'after': history_cursor(messages[-1])
+        if messages and (has_more or before) else None,
+    })
+
+
 @login_required
 def call_view(request, username):
     """ Call page. """